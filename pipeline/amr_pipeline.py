@@ -16,12 +16,18 @@ Pipeline Components:
 """
 
 import os
+import re
+import gzip
 import sys
+import time
+import shutil
+import tempfile
 import subprocess
 import logging
 from pathlib import Path
-from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 import json
 
 # ============================================================================
@@ -44,10 +50,52 @@ class PipelineConfig:
     min_read_length: int = 50
     min_quality: int = 20
     
+    # Trimmed read handoff between fastp and RGI
+    trim_compression_level: int = 4             # fastp -z (1 = fastest, 9 = smallest)
+    stream_trimmed_reads: Optional[str] = None   # None, 'uncompressed' or 'fifo'
+    keep_trimmed_reads: Optional[bool] = None    # Keep trimmed reads for audit (None: unless streamed)
+    scratch_dir: Optional[Path] = None           # Node-local temp space (default: system temp)
+    
+    # Scratch staging of whole samples (see ScratchStaging)
+    stage_to_scratch: bool = False
+    stage_inputs: bool = True                    # Copy raw reads to scratch first
+    scratch_reserve_gb: float = 5.0              # Free space kept untouched
+    
+    # Adaptive per-invocation threads (see ResourcePlanner)
+    adaptive_resources: bool = False
+    memory_reserve_gb: float = 2.0               # RAM left for the OS and Python
+    
+    # CARD k-mer prefilter before RGI (see kmer_prefilter.py)
+    kmer_prefilter: bool = False
+    prefilter_k: int = 25
+    prefilter_min_hits: int = 1                  # Hits needed in either mate
+    kmer_index_path: Optional[Path] = None       # Default: data/card_index/card_k{k}.npy
+    
+    # ResFinder alongside RGI (see ResFinderAnnotation, ToolConcordance)
+    run_resfinder: bool = False
+    resfinder_threads: int = 1                   # Cores taken from RGI's share
+    resfinder_min_identity: float = 0.90
+    resfinder_min_coverage: float = 0.60
+    
+    # Cross-run results database (see results_store.py); None disables it
+    results_db_path: Optional[Path] = None
+    
     # Database paths (to be configured per system)
     card_db_path: Optional[Path] = None
     resfinder_db_path: Optional[Path] = None
     
+    @property
+    def rollup_cache_dir(self) -> Path:
+        """CategoryRollup matrices cached next to the RGI results."""
+        return self.arg_results_dir / "rollup_cache"
+    
+    @property
+    def keeps_trimmed_reads(self) -> bool:
+        """Whether trimmed reads are kept; streamed modes default to no."""
+        if self.keep_trimmed_reads is None:
+            return self.stream_trimmed_reads is None
+        return self.keep_trimmed_reads
+    
     def create_directories(self):
         """Create all required directories."""
         for dir_path in [
@@ -108,23 +156,291 @@ def check_tool_availability(tool_name: str) -> bool:
         return False
 
 
+@dataclass
+class CommandProfile:
+    """Wall time and peak memory of a finished command."""
+    wall_seconds: float
+    peak_rss_bytes: Optional[int] = None
+
+
+def total_file_size(paths: List[Optional[Path]]) -> int:
+    """Total size in bytes of the existing files among paths."""
+    return sum(p.stat().st_size for p in paths if p is not None and p.exists())
+
+
+def run_command_profiled(cmd: List[str], logger: logging.Logger,
+                         description: str = "") -> Tuple[int, str, str, CommandProfile]:
+    """
+    Execute a shell command, log output and measure its resource usage.
+    
+    Peak RSS covers the command and the descendants it waited for (e.g.
+    the aligners RGI spawns). It is unavailable on platforms without wait4.
+    """
+    logger.info(f"Running: {description or ' '.join(cmd[:3])}...")
+    
+    start = time.monotonic()
+    peak_rss = None
+    
+    # Output goes to temp files so the child can be reaped with wait4
+    with tempfile.TemporaryFile(mode="w+") as out, \
+         tempfile.TemporaryFile(mode="w+") as err:
+        process = subprocess.Popen(cmd, stdout=out, stderr=err, text=True)
+        
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+            peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        else:
+            process.wait()
+        
+        out.seek(0)
+        err.seek(0)
+        stdout, stderr = out.read(), err.read()
+    
+    profile = CommandProfile(time.monotonic() - start, peak_rss)
+    
+    if process.returncode != 0:
+        logger.error(f"Command failed: {stderr}")
+    else:
+        logger.info(f"Completed: {description}")
+    
+    return process.returncode, stdout, stderr, profile
+
+
 def run_command(cmd: List[str], logger: logging.Logger, 
                 description: str = "") -> Tuple[int, str, str]:
     """Execute a shell command and log output."""
-    logger.info(f"Running: {description or ' '.join(cmd[:3])}...")
+    returncode, stdout, stderr, _ = run_command_profiled(cmd, logger, description)
+    return returncode, stdout, stderr
+
+
+def run_streaming_pair(producer_cmd: List[str],
+                       consumer_cmd: List[str],
+                       logger: logging.Logger,
+                       description: str = "",
+                       grace_seconds: float = 30.0) -> Tuple[int, int]:
+    """
+    Run a producer and a consumer that communicate through named pipes.
     
-    result = subprocess.run(
-        cmd,
-        capture_output=True,
-        text=True
-    )
+    If either side fails, the other is terminated so neither blocks forever
+    on a pipe with no peer.
     
-    if result.returncode != 0:
-        logger.error(f"Command failed: {result.stderr}")
-    else:
+    Returns:
+        (producer_returncode, consumer_returncode)
+    """
+    logger.info(f"Running (streamed): {description or ' '.join(producer_cmd[:3])}...")
+    
+    # stderr goes to temp files so a chatty tool cannot fill an OS pipe
+    with tempfile.TemporaryFile(mode="w+") as producer_err, \
+         tempfile.TemporaryFile(mode="w+") as consumer_err:
+        producer = subprocess.Popen(producer_cmd, stdout=subprocess.DEVNULL,
+                                    stderr=producer_err, text=True)
+        consumer = subprocess.Popen(consumer_cmd, stdout=subprocess.DEVNULL,
+                                    stderr=consumer_err, text=True)
+        
+        while True:
+            producer_rc = producer.poll()
+            consumer_rc = consumer.poll()
+            
+            if producer_rc is not None and consumer_rc is not None:
+                break
+            
+            if producer_rc not in (None, 0) and consumer_rc is None:
+                consumer.terminate()
+            elif consumer_rc is not None and producer_rc is None:
+                try:
+                    producer.wait(timeout=grace_seconds)
+                except subprocess.TimeoutExpired:
+                    producer.kill()
+            
+            time.sleep(0.5)
+        
+        for name, rc, err in [("producer", producer_rc, producer_err),
+                              ("consumer", consumer_rc, consumer_err)]:
+            if rc != 0:
+                err.seek(0)
+                logger.error(f"Streamed {name} failed: {err.read()}")
+    
+    if producer_rc == 0 and consumer_rc == 0:
         logger.info(f"Completed: {description}")
     
-    return result.returncode, result.stdout, result.stderr
+    return producer_rc, consumer_rc
+
+
+# ============================================================================
+# RESOURCE PLANNING
+# ============================================================================
+
+@dataclass
+class ToolAllocation:
+    """Threads and memory planned for one tool invocation."""
+    tool: str
+    threads: int
+    memory_bytes: int
+    max_concurrent: int
+
+
+class ResourcePlanner:
+    """
+    Size threads and concurrency per tool invocation.
+    
+    Plans start from a static model of each tool (useful thread range and
+    memory per thread / per input byte) and are corrected by peak RSS
+    recorded from earlier runs, stored in logs_dir/resource_profiles.json.
+    Threads are reduced until the memory estimate fits available RAM.
+    """
+    
+    GB = 1024 ** 3
+    
+    # max_threads: None = one thread per input file (FastQC)
+    # bytes_per_thread: input size that justifies one more thread
+    TOOL_MODELS = {
+        "fastqc": {"max_threads": None, "bytes_per_thread": None,
+                   "base_memory": 0, "thread_memory": 512 * 1024 ** 2,
+                   "input_memory_ratio": 0.0},
+        "fastp": {"max_threads": 16, "bytes_per_thread": 512 * 1024 ** 2,
+                  "base_memory": 1 * 1024 ** 3, "thread_memory": 256 * 1024 ** 2,
+                  "input_memory_ratio": 0.0},
+        "rgi": {"max_threads": 32, "bytes_per_thread": 256 * 1024 ** 2,
+                "base_memory": 4 * 1024 ** 3, "thread_memory": 512 * 1024 ** 2,
+                "input_memory_ratio": 0.25},
+    }
+    
+    # Headroom applied to memory observed in past runs
+    PROFILE_HEADROOM = 1.2
+    # Largest input ratio over which a recorded peak is extrapolated
+    PROFILE_MAX_SCALE = 4.0
+    MAX_PROFILES_PER_TOOL = 200
+    
+    def __init__(self, config: PipelineConfig, logger: logging.Logger,
+                 profile_file: Optional[Path] = None):
+        self.config = config
+        self.logger = logger
+        self.profile_file = profile_file or config.logs_dir / "resource_profiles.json"
+        self.profiles = self._load_profiles()
+    
+    # ------------------------------------------------------------------
+    # Machine resources
+    # ------------------------------------------------------------------
+    
+    @staticmethod
+    def available_cores() -> int:
+        """CPU cores this process may run on."""
+        if hasattr(os, "sched_getaffinity"):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+    
+    @staticmethod
+    def available_memory() -> int:
+        """Currently available RAM in bytes."""
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            return 8 * ResourcePlanner.GB
+    
+    # ------------------------------------------------------------------
+    # Planning
+    # ------------------------------------------------------------------
+    
+    def estimate_memory(self, tool: str, input_bytes: int, threads: int) -> int:
+        """Memory estimate from the tool model and recorded peaks."""
+        model = self.TOOL_MODELS[tool]
+        estimate = (model["base_memory"]
+                    + model["thread_memory"] * threads
+                    + model["input_memory_ratio"] * input_bytes)
+        
+        # Past peaks of comparable inputs scale up linearly, never down;
+        # much smaller runs say little about this one and are skipped
+        for record in self.profiles.get(tool, []):
+            if not record.get("peak_rss_bytes"):
+                continue
+            if record["input_bytes"] * self.PROFILE_MAX_SCALE < input_bytes:
+                continue
+            scale = max(1.0, input_bytes / max(record["input_bytes"], 1))
+            estimate = max(estimate,
+                           record["peak_rss_bytes"] * scale * self.PROFILE_HEADROOM)
+        
+        return int(estimate)
+    
+    def plan(self, tool: str, input_bytes: int, n_files: int = 1) -> ToolAllocation:
+        """
+        Plan threads for one invocation of a tool.
+        
+        Args:
+            tool: 'fastqc', 'fastp' or 'rgi'
+            input_bytes: Total size of the input files
+            n_files: Number of input files (FastQC threads across files only)
+        """
+        model = self.TOOL_MODELS[tool]
+        cores = self.available_cores()
+        memory = max(self.available_memory() - int(self.config.memory_reserve_gb * self.GB), 0)
+        
+        if model["max_threads"] is None:
+            threads = max(1, min(n_files, cores))
+        else:
+            wanted = -(-input_bytes // model["bytes_per_thread"])  # ceil
+            threads = max(1, min(wanted, model["max_threads"], cores))
+        
+        memory_bytes = self.estimate_memory(tool, input_bytes, threads)
+        while threads > 1 and memory_bytes > memory:
+            threads -= 1
+            memory_bytes = self.estimate_memory(tool, input_bytes, threads)
+        
+        if memory_bytes > memory:
+            self.logger.warning(
+                f"{tool} may need {memory_bytes / self.GB:.1f} GB, "
+                f"only {memory / self.GB:.1f} GB available"
+            )
+        
+        max_concurrent = max(1, min(cores // threads,
+                                    memory // max(memory_bytes, 1)))
+        
+        return ToolAllocation(tool, threads, memory_bytes, max_concurrent)
+    
+    # ------------------------------------------------------------------
+    # Profiles
+    # ------------------------------------------------------------------
+    
+    def _load_profiles(self) -> Dict[str, List[dict]]:
+        """Load recorded step profiles."""
+        if not self.profile_file.exists():
+            return {}
+        try:
+            with open(self.profile_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Ignoring unreadable resource profiles: {e}")
+            return {}
+    
+    def record(self, tool: str, input_bytes: int, threads: int,
+               profile: Optional[CommandProfile]):
+        """Store the measured usage of a finished invocation."""
+        if profile is None:
+            return
+        
+        records = self.profiles.setdefault(tool, [])
+        records.append({
+            "input_bytes": input_bytes,
+            "threads": threads,
+            "wall_seconds": round(profile.wall_seconds, 2),
+            "peak_rss_bytes": profile.peak_rss_bytes
+        })
+        del records[:-self.MAX_PROFILES_PER_TOOL]
+        
+        # Atomic replace so concurrent workers never read a partial file
+        self.profile_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.profile_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump(self.profiles, f, indent=2)
+        os.replace(tmp_file, self.profile_file)
 
 
 # ============================================================================
@@ -137,41 +453,127 @@ class QualityControl:
     def __init__(self, config: PipelineConfig, logger: logging.Logger):
         self.config = config
         self.logger = logger
+        self.last_profile: Optional[CommandProfile] = None
     
-    def run_fastqc(self, input_file: Path, output_dir: Optional[Path] = None) -> bool:
-        """Run FastQC on a single file."""
-        if not check_tool_availability("fastqc"):
-            self.logger.warning("FastQC not found. Skipping QC step.")
-            return False
+    # Extensions FastQC strips when naming its reports
+    FASTQC_COMPRESSION_SUFFIXES = (".gz", ".bz2")
+    FASTQC_FORMAT_SUFFIXES = (".fastq", ".fq", ".txt", ".sam", ".bam")
+    
+    def build_fastqc_command(self, input_file: Path,
+                             output_dir: Optional[Path] = None,
+                             threads: Optional[int] = None) -> List[str]:
+        """Build the FastQC command line for a single file."""
+        return self.build_fastqc_batch_command([input_file], output_dir, threads)
+    
+    def build_fastqc_batch_command(self, input_files: List[Path],
+                                   output_dir: Optional[Path] = None,
+                                   threads: Optional[int] = None) -> List[str]:
+        """
+        Build one FastQC command line for many files.
         
+        FastQC threads across files, so one JVM with up to one thread per
+        file replaces a JVM per file.
+        """
         output_dir = output_dir or self.config.qc_reports_dir
         
-        cmd = [
+        return [
             "fastqc",
-            str(input_file),
+            *[str(f) for f in input_files],
             "-o", str(output_dir),
-            "-t", str(self.config.threads),
+            "-t", str(threads or min(len(input_files), self.config.threads) or 1),
             "--quiet"
         ]
+    
+    @classmethod
+    def fastqc_report_path(cls, input_file: Path, output_dir: Path) -> Path:
+        """Path of the *_fastqc.zip report FastQC writes for input_file."""
+        name = input_file.name
+        for suffixes in [cls.FASTQC_COMPRESSION_SUFFIXES, cls.FASTQC_FORMAT_SUFFIXES]:
+            for suffix in suffixes:
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+                    break
+        return output_dir / f"{name}_fastqc.zip"
+    
+    def run_fastqc_batch(self,
+                         input_files: List[Path],
+                         output_dir: Optional[Path] = None,
+                         threads: Optional[int] = None,
+                         skip_existing: bool = True,
+                         max_files_per_call: int = 256) -> Dict[Path, bool]:
+        """
+        Run FastQC over many files with as few JVM launches as possible.
         
-        returncode, _, _ = run_command(
+        Args:
+            input_files: FASTQ files to check
+            skip_existing: Reuse reports newer than their input (resumed batches)
+            max_files_per_call: Upper bound on files per FastQC invocation
+        
+        Returns:
+            Mapping of input file to whether its report exists afterwards
+        """
+        if not check_tool_availability("fastqc"):
+            self.logger.warning("FastQC not found. Skipping QC step.")
+            return {f: False for f in input_files}
+        
+        output_dir = output_dir or self.config.qc_reports_dir
+        
+        pending = []
+        for input_file in input_files:
+            report = self.fastqc_report_path(input_file, output_dir)
+            if (skip_existing and report.exists()
+                    and report.stat().st_mtime >= input_file.stat().st_mtime):
+                continue
+            pending.append(input_file)
+        
+        if len(pending) < len(input_files):
+            self.logger.info(
+                f"FastQC: reusing {len(input_files) - len(pending)} existing reports"
+            )
+        
+        for start in range(0, len(pending), max_files_per_call):
+            chunk = pending[start:start + max_files_per_call]
+            cmd = self.build_fastqc_batch_command(chunk, output_dir, threads)
+            _, _, _, self.last_profile = run_command_profiled(
+                cmd, self.logger,
+                f"FastQC on {len(chunk)} files"
+            )
+        
+        # A non-zero exit can hide per-file success, so check the reports
+        return {
+            f: self.fastqc_report_path(f, output_dir).exists()
+            for f in input_files
+        }
+    
+    def run_fastqc(self, input_file: Path, output_dir: Optional[Path] = None,
+                   threads: Optional[int] = None) -> bool:
+        """Run FastQC on a single file."""
+        if not check_tool_availability("fastqc"):
+            self.logger.warning("FastQC not found. Skipping QC step.")
+            return False
+        
+        cmd = self.build_fastqc_command(input_file, output_dir, threads)
+        
+        returncode, _, _, self.last_profile = run_command_profiled(
             cmd, self.logger, 
             f"FastQC on {input_file.name}"
         )
         
         return returncode == 0
     
-    def run_multiqc(self, input_dir: Path, output_dir: Optional[Path] = None) -> bool:
-        """Aggregate QC reports with MultiQC."""
+    def run_multiqc(self, input_dir: Union[Path, List[Path]],
+                    output_dir: Optional[Path] = None) -> bool:
+        """Aggregate QC reports from one or more directories with MultiQC."""
         if not check_tool_availability("multiqc"):
             self.logger.warning("MultiQC not found. Skipping aggregation.")
             return False
         
         output_dir = output_dir or self.config.qc_reports_dir
+        input_dirs = input_dir if isinstance(input_dir, list) else [input_dir]
         
         cmd = [
             "multiqc",
-            str(input_dir),
+            *[str(d) for d in input_dirs],
             "-o", str(output_dir),
             "-f"  # Force overwrite
         ]
@@ -190,43 +592,93 @@ class ReadTrimming:
     def __init__(self, config: PipelineConfig, logger: logging.Logger):
         self.config = config
         self.logger = logger
+        self.last_profile: Optional[CommandProfile] = None
     
-    def run_fastp(self, 
-                  input_r1: Path, 
-                  input_r2: Optional[Path] = None,
-                  output_prefix: Optional[str] = None) -> bool:
-        """Run fastp for quality trimming."""
-        if not check_tool_availability("fastp"):
-            self.logger.warning("fastp not found. Skipping trimming step.")
-            return False
+    def build_fastp_command(self,
+                            input_r1: Path,
+                            input_r2: Optional[Path] = None,
+                            output_prefix: Optional[str] = None,
+                            output_dir: Optional[Path] = None,
+                            compressed: bool = True,
+                            threads: Optional[int] = None) -> List[str]:
+        """
+        Build the fastp command line for a single or paired-end sample.
         
+        Args:
+            output_dir: Where trimmed reads are written (default: trimmed_reads_dir).
+                fastp JSON/HTML reports always go to trimmed_reads_dir.
+            compressed: Write .fastq.gz (True) or plain .fastq (False)
+            threads: Worker threads (default: config.threads)
+        """
         output_prefix = output_prefix or input_r1.stem.replace("_1", "").replace("_R1", "")
-        output_dir = self.config.trimmed_reads_dir
+        report_dir = self.config.trimmed_reads_dir
+        output_dir = output_dir or report_dir
+        suffix = ".fastq.gz" if compressed else ".fastq"
         
         cmd = [
             "fastp",
             "-i", str(input_r1),
-            "-o", str(output_dir / f"{output_prefix}_trimmed_R1.fastq.gz"),
+            "-o", str(output_dir / f"{output_prefix}_trimmed_R1{suffix}"),
             "-q", str(self.config.min_quality),
             "-l", str(self.config.min_read_length),
-            "-w", str(self.config.threads),
-            "-j", str(output_dir / f"{output_prefix}_fastp.json"),
-            "-h", str(output_dir / f"{output_prefix}_fastp.html")
+            "-w", str(threads or self.config.threads),
+            "-j", str(report_dir / f"{output_prefix}_fastp.json"),
+            "-h", str(report_dir / f"{output_prefix}_fastp.html")
         ]
         
+        if compressed:
+            cmd.extend(["-z", str(self.config.trim_compression_level)])
+        
         # Add paired-end options if R2 exists
         if input_r2 and input_r2.exists():
             cmd.extend([
                 "-I", str(input_r2),
-                "-O", str(output_dir / f"{output_prefix}_trimmed_R2.fastq.gz")
+                "-O", str(output_dir / f"{output_prefix}_trimmed_R2{suffix}")
             ])
         
-        returncode, _, _ = run_command(
+        return cmd
+    
+    def run_fastp(self, 
+                  input_r1: Path, 
+                  input_r2: Optional[Path] = None,
+                  output_prefix: Optional[str] = None,
+                  threads: Optional[int] = None) -> bool:
+        """Run fastp for quality trimming."""
+        if not check_tool_availability("fastp"):
+            self.logger.warning("fastp not found. Skipping trimming step.")
+            return False
+        
+        output_prefix = output_prefix or input_r1.stem.replace("_1", "").replace("_R1", "")
+        cmd = self.build_fastp_command(input_r1, input_r2, output_prefix,
+                                       threads=threads)
+        
+        returncode, _, _, self.last_profile = run_command_profiled(
             cmd, self.logger,
             f"fastp trimming for {output_prefix}"
         )
         
         return returncode == 0
+    
+    def parse_fastp_report(self, output_prefix: str) -> Dict[str, int]:
+        """
+        Read totals before and after trimming from the fastp JSON report.
+        
+        Counts are reads (both mates of a pair count), not pairs.
+        
+        Returns:
+            {'raw_reads', 'trimmed_reads'}, or {} without a readable report
+        """
+        report_file = self.config.trimmed_reads_dir / f"{output_prefix}_fastp.json"
+        try:
+            with open(report_file, 'r') as f:
+                summary = json.load(f)["summary"]
+            return {
+                "raw_reads": int(summary["before_filtering"]["total_reads"]),
+                "trimmed_reads": int(summary["after_filtering"]["total_reads"])
+            }
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning(f"No read counts from fastp report {report_file}: {e}")
+            return {}
 
 
 class ARGAnnotation:
@@ -235,19 +687,14 @@ class ARGAnnotation:
     def __init__(self, config: PipelineConfig, logger: logging.Logger):
         self.config = config
         self.logger = logger
+        self.last_profile: Optional[CommandProfile] = None
     
-    def run_rgi_bwt(self, 
-                    input_r1: Path, 
-                    input_r2: Optional[Path] = None,
-                    output_prefix: Optional[str] = None) -> bool:
-        """
-        Run RGI (Resistance Gene Identifier) for metagenomic ARG detection.
-        Uses BWT alignment mode for short reads.
-        """
-        if not check_tool_availability("rgi"):
-            self.logger.warning("RGI not found. Skipping ARG annotation.")
-            return False
-        
+    def build_rgi_bwt_command(self,
+                              input_r1: Path,
+                              input_r2: Optional[Path] = None,
+                              output_prefix: Optional[str] = None,
+                              threads: Optional[int] = None) -> List[str]:
+        """Build the RGI BWT command line for a single or paired-end sample."""
         output_prefix = output_prefix or input_r1.stem.replace("_trimmed_R1", "")
         output_file = self.config.arg_results_dir / output_prefix
         
@@ -255,7 +702,7 @@ class ARGAnnotation:
             "rgi", "bwt",
             "-1", str(input_r1),
             "-o", str(output_file),
-            "-n", str(self.config.threads),
+            "-n", str(threads or self.config.threads),
             "--clean"
         ]
         
@@ -263,51 +710,639 @@ class ARGAnnotation:
         if input_r2 and input_r2.exists():
             cmd.extend(["-2", str(input_r2)])
         
-        returncode, _, _ = run_command(
+        return cmd
+    
+    def run_rgi_bwt(self, 
+                    input_r1: Path, 
+                    input_r2: Optional[Path] = None,
+                    output_prefix: Optional[str] = None,
+                    threads: Optional[int] = None) -> bool:
+        """
+        Run RGI (Resistance Gene Identifier) for metagenomic ARG detection.
+        Uses BWT alignment mode for short reads.
+        """
+        if not check_tool_availability("rgi"):
+            self.logger.warning("RGI not found. Skipping ARG annotation.")
+            return False
+        
+        output_prefix = output_prefix or input_r1.stem.replace("_trimmed_R1", "")
+        cmd = self.build_rgi_bwt_command(input_r1, input_r2, output_prefix, threads)
+        
+        returncode, _, _, self.last_profile = run_command_profiled(
             cmd, self.logger,
             f"RGI BWT annotation for {output_prefix}"
         )
         
         return returncode == 0
     
+    # Annotation level -> gene_mapping_data.txt column (fallback index)
+    ANNOTATION_COLUMNS = {
+        "drug_class": ("Drug Class", 6),
+        "mechanism": ("Resistance Mechanism", 7),
+        "family": ("AMR Gene Family", None),
+    }
+    
+    # Annotation level -> parse_rgi_results key of its category counts
+    CATEGORY_KEYS = {
+        "drug_class": "drug_classes",
+        "mechanism": "mechanisms",
+        "family": "families",
+    }
+    
+    # Category of ARGs without annotation; RGI joins multiple with SEPARATOR
+    UNKNOWN = "Unknown"
+    SEPARATOR = ";"
+    
+    @classmethod
+    def split_categories(cls, value: Optional[str]) -> List[str]:
+        """
+        Distinct categories of a ';'-joined RGI value.
+        
+        The one splitting rule for per-sample counts and CategoryRollup.
+        """
+        if not isinstance(value, str):
+            return [cls.UNKNOWN]
+        parts = dict.fromkeys(part.strip() for part in value.split(cls.SEPARATOR))
+        parts.pop("", None)
+        return list(parts) or [cls.UNKNOWN]
+    
+    def _read_gene_mapping(self, result_file: Path) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """
+        (ARO term, {level: categories}) per row of an RGI gene mapping file.
+        
+        Columns are located by header name, falling back to the positions
+        of older RGI releases.
+        """
+        gene_mapping_file = result_file.with_suffix(".gene_mapping_data.txt")
+        
+        if not gene_mapping_file.exists():
+            self.logger.warning(f"RGI output not found: {gene_mapping_file}")
+            return
+        
+        with open(gene_mapping_file, 'r') as f:
+            header = next(f, "").rstrip('\n').split('\t')
+            positions = {
+                level: header.index(name) if name in header else fallback
+                for level, (name, fallback) in self.ANNOTATION_COLUMNS.items()
+            }
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) >= 10:
+                    yield fields[0], {
+                        level: fields[index] if index is not None and index < len(fields) else self.UNKNOWN
+                        for level, index in positions.items()
+                    }
+    
+    def empty_rgi_results(self, sample: str) -> dict:
+        """parse_rgi_results structure of a sample without ARG hits."""
+        return {
+            "sample": sample,
+            "arg_counts": {},
+            "drug_classes": {},
+            "mechanisms": {},
+            "families": {},
+            "annotations": {}
+        }
+    
     def parse_rgi_results(self, result_file: Path) -> dict:
-        """Parse RGI output into a structured format."""
+        """
+        Parse RGI output into a structured format.
+        
+        Multi-class ARGs count towards each of their ';'-joined drug
+        classes, mechanisms and gene families. 'annotations' keeps the raw
+        categories per ARG for CategoryRollup (see generate_summary).
+        """
+        results = self.empty_rgi_results(result_file.stem)
+        
+        try:
+            for aro_term, categories in self._read_gene_mapping(result_file):
+                # Count ARGs
+                results["arg_counts"][aro_term] = results["arg_counts"].get(aro_term, 0) + 1
+                results["annotations"].setdefault(aro_term, categories)
+                
+                for level, key in self.CATEGORY_KEYS.items():
+                    counts = results[key]
+                    for category in self.split_categories(categories[level]):
+                        counts[category] = counts.get(category, 0) + 1
+        
+        except Exception as e:
+            self.logger.error(f"Error parsing RGI results: {e}")
+        
+        return results
+    
+    def parse_rgi_annotations(self, result_file: Path) -> Dict[str, Dict[str, str]]:
+        """
+        Read the CARD categories of each ARG in an RGI result.
+        
+        Values keep RGI's ';'-joined form; CategoryRollup splits them.
+        
+        Returns:
+            Dictionary mapping ARO term to {level: categories}
+        """
+        annotations = {}
+        
+        try:
+            for aro_term, categories in self._read_gene_mapping(result_file):
+                annotations.setdefault(aro_term, categories)
+        
+        except Exception as e:
+            self.logger.error(f"Error parsing RGI annotations: {e}")
+        
+        return annotations
+
+
+class ResFinderAnnotation:
+    """Acquired resistance gene annotation using ResFinder (KMA on reads)."""
+    
+    EXECUTABLE = "run_resfinder.py"
+    
+    # ResFinder output -> flat artifact suffix in arg_results_dir
+    RESULT_FILES = {
+        "ResFinder_results_tab.txt": "_resfinder_results_tab.txt",
+        "pheno_table.txt": "_resfinder_pheno_table.txt",
+    }
+    
+    def __init__(self, config: PipelineConfig, logger: logging.Logger):
+        self.config = config
+        self.logger = logger
+        self.last_profile: Optional[CommandProfile] = None
+    
+    def build_resfinder_command(self,
+                                input_r1: Path,
+                                input_r2: Optional[Path],
+                                output_dir: Path) -> List[str]:
+        """Build the ResFinder command line for acquired genes from reads."""
+        reads = [str(input_r1)]
+        if input_r2 and input_r2.exists():
+            reads.append(str(input_r2))
+        
+        cmd = [
+            self.EXECUTABLE,
+            "-ifq", *reads,
+            "-o", str(output_dir),
+            "-acq",
+            "-t", str(self.config.resfinder_min_identity),
+            "-l", str(self.config.resfinder_min_coverage)
+        ]
+        
+        if self.config.resfinder_db_path:
+            cmd.extend(["-db_res", str(self.config.resfinder_db_path)])
+        
+        return cmd
+    
+    def run_resfinder(self,
+                      input_r1: Path,
+                      input_r2: Optional[Path] = None,
+                      output_prefix: Optional[str] = None) -> bool:
+        """
+        Run ResFinder on trimmed reads.
+        
+        ResFinder writes into its own directory; the result tables are
+        moved to arg_results_dir as {prefix}_resfinder_*.txt.
+        """
+        if not check_tool_availability(self.EXECUTABLE):
+            self.logger.warning("ResFinder not found. Skipping ResFinder annotation.")
+            return False
+        
+        output_prefix = output_prefix or input_r1.stem.replace("_trimmed_R1", "")
+        if self.config.scratch_dir is not None:
+            self.config.scratch_dir.mkdir(parents=True, exist_ok=True)
+        work_dir = Path(tempfile.mkdtemp(prefix=f"amr_resfinder_{output_prefix}_",
+                                         dir=self.config.scratch_dir))
+        
+        try:
+            cmd = self.build_resfinder_command(input_r1, input_r2, work_dir)
+            returncode, _, _, self.last_profile = run_command_profiled(
+                cmd, self.logger,
+                f"ResFinder annotation for {output_prefix}"
+            )
+            
+            for name, suffix in self.RESULT_FILES.items():
+                produced = work_dir / name
+                if produced.exists():
+                    shutil.move(str(produced),
+                                str(self.config.arg_results_dir / f"{output_prefix}{suffix}"))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        
+        return returncode == 0
+    
+    def parse_resfinder_results(self, output_prefix: str) -> dict:
+        """Parse ResFinder tables into the same structure as parse_rgi_results."""
         results = {
-            "sample": result_file.stem,
+            "sample": output_prefix,
             "arg_counts": {},
-            "drug_classes": {},
-            "mechanisms": {}
+            "drug_classes": {}
         }
         
-        # RGI BWT outputs tab-separated files
-        gene_mapping_file = result_file.with_suffix(".gene_mapping_data.txt")
+        hits_file = self.config.arg_results_dir / \
+            f"{output_prefix}{self.RESULT_FILES['ResFinder_results_tab.txt']}"
+        pheno_file = self.config.arg_results_dir / \
+            f"{output_prefix}{self.RESULT_FILES['pheno_table.txt']}"
         
-        if not gene_mapping_file.exists():
-            self.logger.warning(f"RGI output not found: {gene_mapping_file}")
+        if not hits_file.exists():
+            self.logger.warning(f"ResFinder output not found: {hits_file}")
             return results
         
         try:
-            with open(gene_mapping_file, 'r') as f:
+            with open(hits_file, 'r') as f:
                 # Skip header
                 next(f, None)
                 for line in f:
-                    fields = line.strip().split('\t')
-                    if len(fields) >= 10:
-                        aro_term = fields[0]
-                        drug_class = fields[6] if len(fields) > 6 else "Unknown"
-                        mechanism = fields[7] if len(fields) > 7 else "Unknown"
-                        
-                        # Count ARGs
-                        results["arg_counts"][aro_term] = results["arg_counts"].get(aro_term, 0) + 1
-                        results["drug_classes"][drug_class] = results["drug_classes"].get(drug_class, 0) + 1
-                        results["mechanisms"][mechanism] = results["mechanisms"].get(mechanism, 0) + 1
+                    fields = line.rstrip('\n').split('\t')
+                    if fields and fields[0]:
+                        gene = fields[0]
+                        results["arg_counts"][gene] = results["arg_counts"].get(gene, 0) + 1
+            
+            # Classes predicted resistant: "Antimicrobial  Class  Phenotype  ..."
+            if pheno_file.exists():
+                with open(pheno_file, 'r') as f:
+                    for line in f:
+                        if line.startswith('#'):
+                            continue
+                        fields = line.rstrip('\n').split('\t')
+                        if len(fields) >= 3 and fields[2] == "Resistant":
+                            drug_class = fields[1]
+                            results["drug_classes"][drug_class] = \
+                                results["drug_classes"].get(drug_class, 0) + 1
         
         except Exception as e:
-            self.logger.error(f"Error parsing RGI results: {e}")
+            self.logger.error(f"Error parsing ResFinder results: {e}")
         
         return results
 
 
+class ToolConcordance:
+    """
+    Agreement between RGI and ResFinder calls for one sample.
+    
+    Both tools' hits are mapped onto shared keys: a normalized gene name
+    (case, 'bla' prefix, punctuation and sub-allele letter removed, so
+    'blaTEM-1B' and 'TEM-1' agree) and a drug class vocabulary bridging CARD classes
+    ('penam', 'fluoroquinolone antibiotic') and ResFinder classes
+    ('beta-lactam', 'quinolone').
+    """
+    
+    DRUG_CLASS_SYNONYMS = {
+        "penam": "beta-lactam",
+        "penem": "beta-lactam",
+        "carbapenem": "beta-lactam",
+        "cephalosporin": "beta-lactam",
+        "cephamycin": "beta-lactam",
+        "monobactam": "beta-lactam",
+        "fluoroquinolone": "quinolone",
+        "phenicol": "amphenicol",
+        "sulfonamide": "folate pathway antagonist",
+        "sulphonamide": "folate pathway antagonist",
+        "diaminopyrimidine": "folate pathway antagonist",
+        "trimethoprim": "folate pathway antagonist",
+        "peptide": "polymyxin",
+        "streptogramin a": "streptogramin",
+        "streptogramin b": "streptogramin",
+    }
+    
+    @staticmethod
+    def gene_key(name: str) -> str:
+        """Normalized gene name shared by CARD ARO terms and ResFinder genes."""
+        key = name.strip().lower().split("_")[0]  # drop ResFinder allele/accession
+        if key.startswith("bla"):
+            key = key[3:]
+        key = re.sub(r"[^a-z0-9]", "", key)
+        return re.sub(r"(\d)[a-z]$", r"\1", key)  # ResFinder sub-allele: TEM-1B -> TEM-1
+    
+    @classmethod
+    def drug_class_keys(cls, drug_class: str) -> List[str]:
+        """Shared class keys for a (possibly ';'-joined) drug class label."""
+        keys = []
+        for part in drug_class.split(";"):
+            part = part.strip().lower()
+            if part.endswith(" antibiotic"):
+                part = part[:-len(" antibiotic")]
+            if part and part != "unknown":
+                keys.append(cls.DRUG_CLASS_SYNONYMS.get(part, part))
+        return keys
+    
+    @staticmethod
+    def _agreement(rgi: set, resfinder: set) -> dict:
+        union = rgi | resfinder
+        shared = rgi & resfinder
+        return {
+            "rgi": len(rgi),
+            "resfinder": len(resfinder),
+            "shared": sorted(shared),
+            "rgi_only": sorted(rgi - resfinder),
+            "resfinder_only": sorted(resfinder - rgi),
+            "jaccard": round(len(shared) / len(union), 4) if union else None
+        }
+    
+    @classmethod
+    def compare(cls, rgi_results: dict, resfinder_results: dict) -> dict:
+        """Gene and drug class agreement of two parsed result dictionaries."""
+        def class_set(results: dict) -> set:
+            return {key for label in results.get("drug_classes", {})
+                    for key in cls.drug_class_keys(label)}
+        
+        return {
+            "genes": cls._agreement(
+                {cls.gene_key(g) for g in rgi_results.get("arg_counts", {})},
+                {cls.gene_key(g) for g in resfinder_results.get("arg_counts", {})}
+            ),
+            "drug_classes": cls._agreement(class_set(rgi_results),
+                                           class_set(resfinder_results))
+        }
+    
+    @staticmethod
+    def summarize(results: List[dict]) -> dict:
+        """Mean agreement over the samples that have a concordance entry."""
+        def mean_jaccard(level: str) -> Optional[float]:
+            values = [r["concordance"][level]["jaccard"] for r in results
+                      if r.get("concordance")
+                      and r["concordance"][level]["jaccard"] is not None]
+            return round(sum(values) / len(values), 4) if values else None
+        
+        return {
+            "samples": sum(1 for r in results if r.get("concordance")),
+            "mean_gene_jaccard": mean_jaccard("genes"),
+            "mean_drug_class_jaccard": mean_jaccard("drug_classes")
+        }
+
+
+class StreamingHandoff:
+    """
+    Trimming and ARG annotation without the gzip round-trip.
+    
+    Modes (PipelineConfig.stream_trimmed_reads):
+    - 'uncompressed': fastp writes plain FASTQ to local scratch, RGI reads it
+    - 'fifo': fastp writes into named pipes that RGI reads concurrently,
+      so trimmed reads never touch the disk
+    
+    Trimmed reads are not kept unless keep_trimmed_reads is set
+    explicitly. Then 'fifo' falls back to 'uncompressed' and the plain FASTQ
+    files are gzipped into trimmed_reads_dir after annotation, so the shared
+    filesystem receives no more than the gzip path would write.
+    
+    In 'fifo' mode fastp and RGI run at the same time and share one thread
+    budget; fastp gets FASTP_THREAD_SHARE of it.
+    """
+    
+    MODES = ("uncompressed", "fifo")
+    FASTP_THREAD_SHARE = 0.25
+    
+    def __init__(self, config: PipelineConfig, logger: logging.Logger,
+                 trimmer: ReadTrimming, annotator: ARGAnnotation):
+        self.config = config
+        self.logger = logger
+        self.trimmer = trimmer
+        self.annotator = annotator
+    
+    def run(self,
+            sample_id: str,
+            r1_path: Path,
+            r2_path: Optional[Path] = None,
+            fastp_threads: Optional[int] = None,
+            rgi_threads: Optional[int] = None) -> Tuple[bool, bool]:
+        """
+        Trim and annotate one sample.
+        
+        Returns:
+            (trimming_passed, annotation_passed)
+        """
+        mode = self.config.stream_trimmed_reads
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown stream_trimmed_reads mode: {mode}")
+        
+        for tool in ["fastp", "rgi"]:
+            if not check_tool_availability(tool):
+                self.logger.warning(f"{tool} not found. Skipping trimming/annotation.")
+                return False, False
+        
+        if mode == "fifo" and self.config.keeps_trimmed_reads:
+            self.logger.warning("keep_trimmed_reads requires files; using 'uncompressed' mode")
+            mode = "uncompressed"
+        
+        if mode == "fifo":
+            fastp_threads, rgi_threads = self.split_threads(fastp_threads, rgi_threads)
+        
+        paired = r2_path is not None and r2_path.exists()
+        scratch = self.config.scratch_dir
+        if scratch is not None:
+            scratch.mkdir(parents=True, exist_ok=True)
+        work_dir = Path(tempfile.mkdtemp(prefix=f"amr_{sample_id}_", dir=scratch))
+        
+        try:
+            trimmed_r1 = work_dir / f"{sample_id}_trimmed_R1.fastq"
+            trimmed_r2 = work_dir / f"{sample_id}_trimmed_R2.fastq" if paired else None
+            
+            fastp_cmd = self.trimmer.build_fastp_command(
+                r1_path, r2_path if paired else None, sample_id,
+                output_dir=work_dir, compressed=False, threads=fastp_threads
+            )
+            
+            if mode == "fifo":
+                os.mkfifo(trimmed_r1)
+                if trimmed_r2:
+                    os.mkfifo(trimmed_r2)
+                
+                rgi_cmd = self.annotator.build_rgi_bwt_command(
+                    trimmed_r1, trimmed_r2, sample_id, rgi_threads
+                )
+                fastp_rc, rgi_rc = run_streaming_pair(
+                    fastp_cmd, rgi_cmd, self.logger,
+                    f"fastp -> RGI BWT for {sample_id}"
+                )
+                return fastp_rc == 0, fastp_rc == 0 and rgi_rc == 0
+            
+            returncode, _, _ = run_command(
+                fastp_cmd, self.logger,
+                f"fastp trimming (uncompressed) for {sample_id}"
+            )
+            if returncode != 0:
+                return False, False
+            
+            rgi_cmd = self.annotator.build_rgi_bwt_command(
+                trimmed_r1, trimmed_r2, sample_id, rgi_threads
+            )
+            returncode, _, _ = run_command(
+                rgi_cmd, self.logger,
+                f"RGI BWT annotation for {sample_id}"
+            )
+            
+            if self.config.keeps_trimmed_reads:
+                for trimmed in [trimmed_r1, trimmed_r2]:
+                    if trimmed and trimmed.exists():
+                        self.keep_gzipped(trimmed)
+            
+            return True, returncode == 0
+        
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def split_threads(self,
+                      fastp_threads: Optional[int],
+                      rgi_threads: Optional[int]) -> Tuple[int, int]:
+        """Divide one thread budget between concurrently running fastp and RGI."""
+        budget = max(fastp_threads or 0, rgi_threads or 0) or self.config.threads
+        fastp = max(1, int(budget * self.FASTP_THREAD_SHARE))
+        return fastp, max(1, budget - fastp)
+    
+    def keep_gzipped(self, trimmed: Path) -> Path:
+        """Gzip a plain trimmed FASTQ from scratch into trimmed_reads_dir."""
+        self.config.trimmed_reads_dir.mkdir(parents=True, exist_ok=True)
+        target = self.config.trimmed_reads_dir / f"{trimmed.name}.gz"
+        partial = target.with_name(target.name + ".partial")
+        with open(trimmed, 'rb') as source, \
+             gzip.open(partial, 'wb', compresslevel=self.config.trim_compression_level) as sink:
+            shutil.copyfileobj(source, sink, 1 << 20)
+        os.replace(partial, target)
+        return target
+
+
+class ScratchStaging:
+    """
+    Run a sample on node-local scratch and move only final artifacts back.
+    
+    Raw reads are copied to a per-sample scratch directory (stage_inputs),
+    all tools write there, and afterwards QC reports, fastp reports, RGI
+    outputs and (with keep_trimmed_reads) trimmed reads are moved into the
+    configured data directories. The scratch directory is removed even if
+    a step fails. Free space on scratch and on the destination is checked
+    before anything is copied.
+    """
+    
+    # Bytes needed per byte of gzipped input
+    TRIMMED_GZ_FACTOR = 1.0
+    TRIMMED_PLAIN_FACTOR = 4.0
+    RGI_TEMP_FACTOR = 1.0
+    
+    def __init__(self, config: PipelineConfig, logger: logging.Logger):
+        self.config = config
+        self.logger = logger
+    
+    @property
+    def scratch_root(self) -> Path:
+        """Directory under which per-sample scratch directories are made."""
+        return Path(self.config.scratch_dir or tempfile.gettempdir())
+    
+    def estimate_space(self,
+                       r1_path: Path,
+                       r2_path: Optional[Path] = None) -> Tuple[int, int]:
+        """
+        Estimate disk usage for a sample.
+        
+        Returns:
+            (scratch_bytes, destination_bytes)
+        """
+        input_bytes = sum(p.stat().st_size for p in [r1_path, r2_path]
+                          if p is not None and p.exists())
+        
+        plain = self.config.stream_trimmed_reads is not None
+        trimmed_factor = self.TRIMMED_PLAIN_FACTOR if plain else self.TRIMMED_GZ_FACTOR
+        if self.config.stream_trimmed_reads == "fifo" and not self.config.keeps_trimmed_reads:
+            trimmed_factor = 0.0
+        
+        scratch_bytes = input_bytes * (trimmed_factor + self.RGI_TEMP_FACTOR)
+        if self.config.stage_inputs:
+            scratch_bytes += input_bytes
+        
+        # Kept trimmed reads are gzipped on the way out in every mode
+        destination_bytes = (input_bytes * self.TRIMMED_GZ_FACTOR
+                             if self.config.keeps_trimmed_reads else 0)
+        
+        return int(scratch_bytes), int(destination_bytes)
+    
+    def has_space(self, path: Path, required_bytes: int) -> bool:
+        """Check that path keeps scratch_reserve_gb free after required_bytes."""
+        free = shutil.disk_usage(path).free
+        reserve = int(self.config.scratch_reserve_gb * 1024 ** 3)
+        
+        if free - required_bytes < reserve:
+            self.logger.error(
+                f"Insufficient space on {path}: need {required_bytes / 1024 ** 3:.1f} GB "
+                f"+ {self.config.scratch_reserve_gb:.1f} GB reserve, "
+                f"{free / 1024 ** 3:.1f} GB free"
+            )
+            return False
+        return True
+    
+    def run(self,
+            sample_id: str,
+            r1_path: Path,
+            r2_path: Optional[Path],
+            runner: Callable[..., dict]) -> dict:
+        """
+        Stage a sample, run it and collect artifacts.
+        
+        Args:
+            runner: Called as runner(staged_config, sample_id, r1, r2)
+        """
+        scratch_root = self.scratch_root
+        scratch_root.mkdir(parents=True, exist_ok=True)
+        
+        scratch_bytes, destination_bytes = self.estimate_space(r1_path, r2_path)
+        if not (self.has_space(scratch_root, scratch_bytes)
+                and self.has_space(self.config.trimmed_reads_dir, destination_bytes)):
+            return {
+                "sample_id": sample_id,
+                "qc_passed": False,
+                "trimming_passed": False,
+                "annotation_passed": False,
+                "arg_results": None,
+                "error": "insufficient disk space"
+            }
+        
+        work_dir = Path(tempfile.mkdtemp(prefix=f"amr_stage_{sample_id}_", dir=scratch_root))
+        self.logger.info(f"Staging {sample_id} in {work_dir}")
+        
+        try:
+            staged = replace(
+                self.config,
+                raw_reads_dir=work_dir / "raw_reads",
+                trimmed_reads_dir=work_dir / "trimmed_reads",
+                qc_reports_dir=work_dir / "qc_reports",
+                arg_results_dir=work_dir / "arg_annotation",
+                scratch_dir=work_dir / "tmp",
+                stage_to_scratch=False
+            )
+            staged.create_directories()
+            staged.scratch_dir.mkdir()
+            
+            if self.config.stage_inputs:
+                r1_path = self._copy_in(r1_path, staged.raw_reads_dir)
+                if r2_path:
+                    r2_path = self._copy_in(r2_path, staged.raw_reads_dir)
+            
+            results = runner(staged, sample_id, r1_path, r2_path)
+            self.collect_artifacts(staged)
+            return results
+        
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def _copy_in(self, source: Path, target_dir: Path) -> Path:
+        """Copy an input file to scratch."""
+        target = target_dir / source.name
+        shutil.copyfile(source, target)
+        return target
+    
+    def collect_artifacts(self, staged: PipelineConfig):
+        """Move final artifacts from scratch into the configured directories."""
+        moves = [
+            (staged.qc_reports_dir, self.config.qc_reports_dir, None),
+            (staged.arg_results_dir, self.config.arg_results_dir, None),
+            (staged.trimmed_reads_dir, self.config.trimmed_reads_dir,
+             None if self.config.keeps_trimmed_reads else ("_fastp.json", "_fastp.html")),
+        ]
+        
+        for source_dir, target_dir, suffixes in moves:
+            target_dir.mkdir(parents=True, exist_ok=True)
+            for artifact in source_dir.iterdir():
+                if not artifact.is_file():
+                    continue
+                if suffixes and not artifact.name.endswith(suffixes):
+                    continue
+                shutil.move(str(artifact), str(target_dir / artifact.name))
+
+
 # ============================================================================
 # MAIN PIPELINE ORCHESTRATION
 # ============================================================================
@@ -326,10 +1361,26 @@ class AMRPipeline:
         self.qc = QualityControl(config, self.logger)
         self.trimmer = ReadTrimming(config, self.logger)
         self.annotator = ARGAnnotation(config, self.logger)
+        self.resfinder = ResFinderAnnotation(config, self.logger)
+        self.streaming = StreamingHandoff(config, self.logger,
+                                          self.trimmer, self.annotator)
+        self.staging = ScratchStaging(config, self.logger)
+        self.planner = ResourcePlanner(config, self.logger)
+        self._prefilter = None
+    
+    @property
+    def prefilter(self):
+        """CARD k-mer prefilter, imported on first use (requires NumPy)."""
+        if self._prefilter is None:
+            from kmer_prefilter import KmerPrefilter
+            self._prefilter = KmerPrefilter(self.config, self.logger)
+        return self._prefilter
     
     def check_dependencies(self) -> dict:
         """Check availability of required tools."""
         tools = ["fastqc", "multiqc", "fastp", "rgi"]
+        if self.config.run_resfinder:
+            tools.append(ResFinderAnnotation.EXECUTABLE)
         status = {}
         
         self.logger.info("Checking tool dependencies...")
@@ -343,12 +1394,43 @@ class AMRPipeline:
     def process_sample(self, 
                        sample_id: str,
                        r1_path: Path,
-                       r2_path: Optional[Path] = None) -> dict:
-        """Run full pipeline on a single sample."""
+                       r2_path: Optional[Path] = None,
+                       run_qc: bool = True) -> dict:
+        """
+        Run full pipeline on a single sample.
+        
+        Args:
+            run_qc: Set False when FastQC already ran for the batch
+        """
         self.logger.info(f"=" * 60)
         self.logger.info(f"Processing sample: {sample_id}")
         self.logger.info(f"=" * 60)
         
+        if self.config.stage_to_scratch:
+            return self.staging.run(
+                sample_id, r1_path, r2_path,
+                lambda config, sid, r1, r2: self._run_steps(config, sid, r1, r2, run_qc)
+            )
+        
+        return self._run_steps(self.config, sample_id, r1_path, r2_path, run_qc)
+    
+    def _run_steps(self,
+                   config: PipelineConfig,
+                   sample_id: str,
+                   r1_path: Path,
+                   r2_path: Optional[Path] = None,
+                   run_qc: bool = True) -> dict:
+        """Run QC, trimming and annotation against the directories in config."""
+        if config is self.config:
+            qc, trimmer, annotator = self.qc, self.trimmer, self.annotator
+            resfinder, streaming = self.resfinder, self.streaming
+        else:
+            qc = QualityControl(config, self.logger)
+            trimmer = ReadTrimming(config, self.logger)
+            annotator = ARGAnnotation(config, self.logger)
+            resfinder = ResFinderAnnotation(config, self.logger)
+            streaming = StreamingHandoff(config, self.logger, trimmer, annotator)
+        
         results = {
             "sample_id": sample_id,
             "qc_passed": False,
@@ -357,89 +1439,346 @@ class AMRPipeline:
             "arg_results": None
         }
         
-        # Step 1: Initial QC
-        self.logger.info("Step 1: Quality Control")
-        results["qc_passed"] = self.qc.run_fastqc(r1_path)
-        if r2_path:
-            self.qc.run_fastqc(r2_path)
+        # Step 1: Initial QC (R1 and R2 in one FastQC invocation)
+        if run_qc:
+            self.logger.info("Step 1: Quality Control")
+            reads = [p for p in [r1_path, r2_path] if p]
+            qc_status = self._run_planned(
+                "fastqc", reads, qc,
+                lambda threads: qc.run_fastqc_batch(reads, threads=threads)
+            )
+            results["qc_passed"] = qc_status[r1_path]
+        
+        # Steps 2-3 streamed: trimmed reads bypass gzip and trimmed_reads_dir
+        if config.stream_trimmed_reads:
+            self.logger.info("Steps 2-3: Read Trimming + ARG Annotation (streamed)")
+            if config.kmer_prefilter:
+                self.logger.warning("k-mer prefilter is not applied to streamed reads")
+            if config.run_resfinder:
+                self.logger.warning("ResFinder is not run on streamed reads")
+            fastp_threads = rgi_threads = None
+            if self.config.adaptive_resources:
+                input_bytes = total_file_size([r1_path, r2_path])
+                fastp_threads = self.planner.plan("fastp", input_bytes).threads
+                rgi_threads = self.planner.plan("rgi", input_bytes).threads
+            
+            results["trimming_passed"], results["annotation_passed"] = \
+                streaming.run(sample_id, r1_path, r2_path, fastp_threads, rgi_threads)
+            
+            if results["trimming_passed"]:
+                results["read_counts"] = trimmer.parse_fastp_report(sample_id)
+                result_file = config.arg_results_dir / sample_id
+                results["arg_results"] = annotator.parse_rgi_results(result_file)
+            
+            self.logger.info(f"Sample {sample_id} processing complete.")
+            return results
         
         # Step 2: Trimming
         self.logger.info("Step 2: Read Trimming")
-        results["trimming_passed"] = self.trimmer.run_fastp(r1_path, r2_path, sample_id)
+        results["trimming_passed"] = self._run_planned(
+            "fastp", [r1_path, r2_path], trimmer,
+            lambda threads: trimmer.run_fastp(r1_path, r2_path, sample_id, threads)
+        )
+        if results["trimming_passed"]:
+            results["read_counts"] = trimmer.parse_fastp_report(sample_id)
         
         # Step 3: ARG Annotation
         self.logger.info("Step 3: ARG Annotation")
-        trimmed_r1 = self.config.trimmed_reads_dir / f"{sample_id}_trimmed_R1.fastq.gz"
-        trimmed_r2 = self.config.trimmed_reads_dir / f"{sample_id}_trimmed_R2.fastq.gz"
+        trimmed_r1 = config.trimmed_reads_dir / f"{sample_id}_trimmed_R1.fastq.gz"
+        trimmed_r2 = config.trimmed_reads_dir / f"{sample_id}_trimmed_R2.fastq.gz"
         
         if trimmed_r1.exists():
-            results["annotation_passed"] = self.annotator.run_rgi_bwt(
-                trimmed_r1, 
-                trimmed_r2 if trimmed_r2.exists() else None,
-                sample_id
-            )
+            trimmed_r2 = trimmed_r2 if trimmed_r2.exists() else None
+            rgi_r1, rgi_r2 = trimmed_r1, trimmed_r2
+            prefilter_dir = None
+            
+            # Optional: pass only reads with CARD k-mer hits to RGI
+            if config.kmer_prefilter:
+                try:
+                    if config.scratch_dir is not None:
+                        config.scratch_dir.mkdir(parents=True, exist_ok=True)
+                    prefilter_dir = Path(tempfile.mkdtemp(prefix=f"amr_prefilter_{sample_id}_",
+                                                          dir=config.scratch_dir))
+                    prefiltered = self.prefilter.filter_reads(
+                        trimmed_r1, trimmed_r2, prefilter_dir, sample_id
+                    )
+                    self.prefilter.write_report(
+                        prefiltered, config.arg_results_dir / f"{sample_id}_prefilter.json"
+                    )
+                    results["prefilter"] = {
+                        "total_reads": prefiltered.total_reads,
+                        "kept_reads": prefiltered.kept_reads,
+                        "filtered_reads": prefiltered.filtered_reads
+                    }
+                    rgi_r1, rgi_r2 = prefiltered.r1_path, prefiltered.r2_path
+                except Exception as e:
+                    self.logger.error(f"Prefilter failed, annotating all reads: {e}")
+            
+            # Optional: ResFinder on all trimmed reads, concurrently with RGI.
+            # Its cores come out of RGI's share so the sample stays in budget.
+            reserved = config.resfinder_threads if config.run_resfinder else 0
+            executor = ThreadPoolExecutor(max_workers=1) if config.run_resfinder else None
+            resfinder_run = executor.submit(
+                resfinder.run_resfinder, trimmed_r1, trimmed_r2, sample_id
+            ) if executor else None
+            
+            # No read shares a k-mer with CARD: nothing for RGI to find, and
+            # an empty FASTQ would only make it fail (and the sample retry)
+            no_candidates = (results.get("prefilter") or {}).get("kept_reads") == 0
+            
+            try:
+                if no_candidates:
+                    self.logger.info(f"No reads of {sample_id} passed the prefilter; skipping RGI")
+                    results["annotation_passed"] = True
+                else:
+                    results["annotation_passed"] = self._run_planned(
+                        "rgi", [rgi_r1, rgi_r2], annotator,
+                        lambda threads: annotator.run_rgi_bwt(
+                            rgi_r1, rgi_r2, sample_id,
+                            max(1, (threads or config.threads) - reserved)
+                        )
+                    )
+            finally:
+                if executor is not None:
+                    # A ResFinder error must not abort the sample (or the batch)
+                    try:
+                        results["resfinder_passed"] = resfinder_run.result()
+                    except Exception as e:
+                        self.logger.error(f"ResFinder failed for {sample_id}: {e}")
+                        results["resfinder_passed"] = False
+                    executor.shutdown()
+                if prefilter_dir is not None:
+                    shutil.rmtree(prefilter_dir, ignore_errors=True)
             
             # Parse results
-            result_file = self.config.arg_results_dir / sample_id
-            results["arg_results"] = self.annotator.parse_rgi_results(result_file)
+            if no_candidates:
+                results["arg_results"] = annotator.empty_rgi_results(sample_id)
+            else:
+                result_file = config.arg_results_dir / sample_id
+                results["arg_results"] = annotator.parse_rgi_results(result_file)
+            
+            if results.get("resfinder_passed"):
+                results["resfinder_results"] = resfinder.parse_resfinder_results(sample_id)
+                results["concordance"] = ToolConcordance.compare(
+                    results["arg_results"], results["resfinder_results"]
+                )
         
         self.logger.info(f"Sample {sample_id} processing complete.")
         return results
     
-    def process_batch(self, manifest_file: Path) -> List[dict]:
-        """Process multiple samples from a manifest file."""
-        all_results = []
+    def _run_planned(self, tool: str, inputs: List[Optional[Path]], component,
+                     run: Callable[[Optional[int]], Any]) -> Any:
+        """
+        Run a step with threads from the ResourcePlanner and record its usage.
+        
+        Without adaptive_resources, run(None) falls back to config.threads.
+        """
+        if not self.config.adaptive_resources:
+            return run(None)
+        
+        input_bytes = total_file_size(inputs)
+        n_files = sum(1 for p in inputs if p is not None)
+        allocation = self.planner.plan(tool, input_bytes, n_files)
+        self.logger.info(
+            f"Planned {tool}: {allocation.threads} threads, "
+            f"~{allocation.memory_bytes / ResourcePlanner.GB:.1f} GB"
+        )
+        
+        component.last_profile = None
+        outcome = run(allocation.threads)
+        self.planner.record(tool, input_bytes, allocation.threads, component.last_profile)
+        
+        return outcome
+    
+    def load_manifest(self, manifest_file: Path) -> List[Tuple[str, Path, Optional[Path]]]:
+        """
+        Resolve manifest accessions to raw read files.
+        
+        Returns:
+            List of (accession, r1_path, r2_path) for samples whose reads exist
+        """
+        samples = []
         
         self.logger.info(f"Loading samples from manifest: {manifest_file}")
         
         # Simple TSV parsing (header: accession, bioproject, ...)
+        with open(manifest_file, 'r') as f:
+            header = f.readline().strip().split('\t')
+            accession_idx = header.index('accession')
+            
+            for line in f:
+                fields = line.strip().split('\t')
+                if len(fields) > accession_idx:
+                    accession = fields[accession_idx]
+                    
+                    # Look for read files
+                    r1 = self.config.raw_reads_dir / f"{accession}_1.fastq.gz"
+                    r2 = self.config.raw_reads_dir / f"{accession}_2.fastq.gz"
+                    
+                    if r1.exists():
+                        samples.append((accession, r1, r2 if r2.exists() else None))
+                    else:
+                        self.logger.warning(f"Read files not found for {accession}")
+        
+        return samples
+    
+    def run_batch_qc(self,
+                     samples: List[Tuple[str, Path, Optional[Path]]]) -> Dict[Path, bool]:
+        """
+        Run FastQC once over the raw reads of every sample in a batch.
+        
+        Reads the inputs where they are; process_batch skips this when
+        samples are staged to scratch (see process_batch).
+        """
+        self.logger.info("Batch Quality Control")
+        reads = [p for _, r1, r2 in samples for p in [r1, r2] if p]
+        if not reads:
+            return {}
+        
+        return self._run_planned(
+            "fastqc", reads, self.qc,
+            lambda threads: self.qc.run_fastqc_batch(reads, threads=threads)
+        )
+    
+    def run_batch_multiqc(self) -> bool:
+        """Aggregate FastQC and fastp reports of the batch with one MultiQC run."""
+        return self.qc.run_multiqc(
+            [self.config.qc_reports_dir, self.config.trimmed_reads_dir]
+        )
+    
+    def process_batch(self, manifest_file: Path) -> List[dict]:
+        """
+        Process multiple samples from a manifest file.
+        
+        FastQC runs once for the batch, except when raw reads are staged to
+        scratch: each sample then runs it on its staged copy, so inputs on
+        network storage are read only by the copy.
+        """
+        all_results = []
+        batch_qc = not (self.config.stage_to_scratch and self.config.stage_inputs)
+        
         try:
-            with open(manifest_file, 'r') as f:
-                header = f.readline().strip().split('\t')
-                accession_idx = header.index('accession')
-                
-                for line in f:
-                    fields = line.strip().split('\t')
-                    if len(fields) > accession_idx:
-                        accession = fields[accession_idx]
-                        
-                        # Look for read files
-                        r1 = self.config.raw_reads_dir / f"{accession}_1.fastq.gz"
-                        r2 = self.config.raw_reads_dir / f"{accession}_2.fastq.gz"
-                        
-                        if r1.exists():
-                            result = self.process_sample(
-                                accession, r1, 
-                                r2 if r2.exists() else None
-                            )
-                            all_results.append(result)
-                        else:
-                            self.logger.warning(f"Read files not found for {accession}")
+            samples = self.load_manifest(manifest_file)
+            qc_status = self.run_batch_qc(samples) if batch_qc else {}
+            
+            for accession, r1, r2 in samples:
+                result = self.process_sample(accession, r1, r2, run_qc=not batch_qc)
+                if batch_qc:
+                    result["qc_passed"] = qc_status.get(r1, False)
+                all_results.append(result)
         
         except Exception as e:
             self.logger.error(f"Error processing manifest: {e}")
         
-        # Generate summary
-        self.generate_summary(all_results)
+        # Aggregate QC reports and generate summary
+        self.run_batch_multiqc()
+        self.generate_summary(all_results, manifest_file)
         
         return all_results
     
-    def generate_summary(self, results: List[dict]):
-        """Generate pipeline execution summary."""
+    def generate_summary(self, results: List[dict],
+                         manifest_file: Optional[Path] = None):
+        """
+        Generate pipeline execution summary.
+        
+        The ARG annotations of all samples are merged into 'arg_annotations'
+        and rolled up into cohort drug class / mechanism / family tables
+        (see write_category_tables). With results_db_path set, results (and
+        the manifest metadata, when given) are also upserted into the
+        cross-run results database.
+        """
         summary_file = self.config.arg_results_dir / "pipeline_summary.json"
+        results, annotations = self._split_annotations(results)
         
         summary = {
             "total_samples": len(results),
             "qc_passed": sum(1 for r in results if r["qc_passed"]),
             "trimming_passed": sum(1 for r in results if r["trimming_passed"]),
-            "annotation_passed": sum(1 for r in results if r["annotation_passed"]),
-            "samples": results
+            "annotation_passed": sum(1 for r in results if r["annotation_passed"])
         }
         
+        # RGI/ResFinder agreement when the ResFinder stage ran
+        if any("resfinder_passed" in r for r in results):
+            summary["resfinder_passed"] = sum(1 for r in results if r.get("resfinder_passed"))
+            summary["concordance"] = ToolConcordance.summarize(results)
+        
+        if self.config.card_db_path is not None:
+            summary["card_db_path"] = str(self.config.card_db_path)
+        summary["arg_annotations"] = annotations
+        if annotations:
+            try:
+                summary["category_tables"] = self.write_category_tables(results, annotations)
+            except Exception as e:
+                self.logger.error(f"Could not write category tables: {e}")
+        
+        summary["samples"] = results
+        
         with open(summary_file, 'w') as f:
             json.dump(summary, f, indent=2)
         
         self.logger.info(f"Summary saved to: {summary_file}")
+        
+        if self.config.results_db_path:
+            from results_store import ResultsStore
+            try:
+                store = ResultsStore(self.config.results_db_path)
+                if manifest_file is not None:
+                    store.ingest_manifest(manifest_file)
+                run_id = store.ingest_results(results, str(summary_file))
+                self.logger.info(f"Results recorded as run {run_id} in: "
+                                 f"{self.config.results_db_path}")
+            except Exception as e:
+                self.logger.error(f"Could not update results database: {e}")
+    
+    @staticmethod
+    def _split_annotations(results: List[dict]) -> Tuple[List[dict], Dict[str, Dict[str, str]]]:
+        """Results without per-sample 'annotations', and all of them merged."""
+        annotations, stripped = {}, []
+        for result in results:
+            arg_results = result.get("arg_results") or {}
+            if "annotations" in arg_results:
+                for arg, categories in arg_results["annotations"].items():
+                    annotations.setdefault(arg, categories)
+                result = {**result, "arg_results": {key: value for key, value in arg_results.items()
+                                                    if key != "annotations"}}
+            stripped.append(result)
+        return stripped, annotations
+    
+    def write_category_tables(self, results: List[dict],
+                              annotations: Dict[str, Dict[str, str]]) -> Dict[str, str]:
+        """
+        Write cohort Categories x Samples tables of the ARG counts.
+        
+        One sparse product with the CategoryRollup gives all levels;
+        tables go to arg_results_dir/abundance_by_{level}.tsv. The rollup
+        covers the configured CARD release (built once, cached in
+        rollup_cache_dir), or only the batch's annotations without one.
+        
+        Returns:
+            Dictionary mapping level to table path
+        """
+        from ecological_analysis import CategoryRollup, ProfileCollection
+        
+        collection = ProfileCollection.from_rgi_results(
+            [r for r in results if r.get("arg_results")], dtype="int64"
+        )
+        card_db_path = self.config.card_db_path
+        if card_db_path is not None and CategoryRollup.aro_index_path(card_db_path).exists():
+            rollup = CategoryRollup.cached(card_db_path, self.config.rollup_cache_dir)
+            missing = sum(1 for arg in annotations if arg not in rollup.args)
+            if missing:
+                self.logger.warning(f"{missing} ARGs not in the CARD index; counted as Unknown")
+        else:
+            rollup = CategoryRollup.from_annotations(annotations)
+        
+        tables = {}
+        for level, table in rollup.rollup_collection(collection).items():
+            table_file = self.config.arg_results_dir / f"abundance_by_{level}.tsv"
+            table.to_csv(table_file, sep='\t')
+            tables[level] = str(table_file)
+        
+        self.logger.info(f"Category tables saved to: {self.config.arg_results_dir}")
+        return tables
 
 
 # ============================================================================
@@ -469,6 +1808,8 @@ def main():
         print("  - MultiQC: pip install multiqc")
         print("  - fastp: conda install -c bioconda fastp")
         print("  - RGI: conda install -c bioconda rgi")
+        if config.run_resfinder:
+            print("  - ResFinder: conda install -c bioconda resfinder")
     else:
         print("\n✓ All dependencies satisfied.")
     
@@ -0,0 +1,486 @@
+"""
+AMR Wastewater Thesis - Asyncio Pipeline Orchestration
+=======================================================
+
+Non-blocking variant of the AMR pipeline for embedding in asyncio-based
+job servers. External tools are launched with asyncio subprocesses, so a
+single event loop can drive thousands of queued samples without a thread
+per sample.
+
+Author: AMR Thesis Project
+Last Updated: 2026-10-18
+
+Features:
+1. Per-tool concurrency limits (asyncio semaphores)
+2. Bounded number of in-flight samples
+3. Cooperative cancellation (running tool processes are killed)
+4. Progress events via callback
+
+Scratch staging, streamed trimming, the k-mer prefilter and ResFinder are
+implemented by AMRPipeline only; with any of them enabled, whole samples
+are run by AMRPipeline.process_sample in a worker thread.
+"""
+
+import asyncio
+import logging
+import time
+from pathlib import Path
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from amr_pipeline import (
+    AMRPipeline,
+    PipelineConfig,
+    check_tool_availability,
+    total_file_size,
+)
+
+
+# ============================================================================
+# PROGRESS EVENTS
+# ============================================================================
+
+@dataclass
+class ProgressEvent:
+    """A state change for one pipeline step of one sample."""
+    sample_id: str
+    step: str       # 'qc', 'trimming', 'annotation', 'parsing', 'pipeline', 'sample'
+    status: str     # 'started', 'completed', 'failed', 'skipped', 'cancelled'
+    timestamp: float
+    detail: str = ""
+
+
+ProgressCallback = Callable[[ProgressEvent], None]
+
+
+# ============================================================================
+# ASYNC UTILITIES
+# ============================================================================
+
+async def run_command_async(cmd: List[str], logger: logging.Logger,
+                            description: str = "") -> Tuple[int, str, str]:
+    """
+    Execute a command without blocking the event loop and log output.
+
+    If the awaiting task is cancelled, the child process is killed before
+    the cancellation propagates.
+    """
+    logger.info(f"Running: {description or ' '.join(cmd[:3])}...")
+
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        logger.warning(f"Cancelled: {description}")
+        raise
+
+    stdout_text = stdout.decode(errors="replace")
+    stderr_text = stderr.decode(errors="replace")
+
+    if process.returncode != 0:
+        logger.error(f"Command failed: {stderr_text}")
+    else:
+        logger.info(f"Completed: {description}")
+
+    return process.returncode, stdout_text, stderr_text
+
+
+# ============================================================================
+# ASYNC PIPELINE ORCHESTRATION
+# ============================================================================
+
+class AsyncAMRPipeline:
+    """Asyncio pipeline orchestrator mirroring AMRPipeline."""
+
+    # Maximum concurrent processes per tool
+    DEFAULT_TOOL_LIMITS = {
+        "fastqc": 4,
+        "fastp": 2,
+        "rgi": 1,
+        "pipeline": 1,   # Whole samples run by AMRPipeline (see delegated_modes)
+    }
+
+    # Limits without a ResourcePlanner model -> tool whose plan sizes them.
+    # A delegated sample's footprint is bounded by its RGI step.
+    PLANNED_AS = {
+        "pipeline": "rgi",
+    }
+
+    def __init__(self,
+                 config: PipelineConfig,
+                 tool_limits: Optional[Dict[str, int]] = None,
+                 max_active_samples: int = 64,
+                 progress_callback: Optional[ProgressCallback] = None):
+        """
+        Args:
+            config: Pipeline configuration shared with AMRPipeline
+            tool_limits: Overrides for DEFAULT_TOOL_LIMITS
+            max_active_samples: Samples allowed in flight at once
+            progress_callback: Called with a ProgressEvent on every step change
+        """
+        self.config = config
+        self.pipeline = AMRPipeline(config)
+        self.logger = self.pipeline.logger
+        self.progress_callback = progress_callback
+
+        limits = dict(self.DEFAULT_TOOL_LIMITS)
+        if config.adaptive_resources:
+            # Cap defaults by what the planner says fits this machine
+            for tool in limits:
+                allocation = self.pipeline.planner.plan(self.PLANNED_AS.get(tool, tool), 0)
+                limits[tool] = min(limits[tool], allocation.max_concurrent)
+        limits.update(tool_limits or {})
+        self.tool_limits = limits
+        self.max_active_samples = max_active_samples
+
+        self._tool_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._sample_semaphore: Optional[asyncio.Semaphore] = None
+        self._tool_available: Dict[str, bool] = {}
+        self._tasks: List[asyncio.Task] = []
+
+        modes = self.delegated_modes
+        if modes:
+            self.logger.info(
+                f"{', '.join(modes)} enabled: samples run through AMRPipeline "
+                f"in worker threads (at most {self.tool_limits['pipeline']} at once)"
+            )
+
+    @property
+    def delegated_modes(self) -> List[str]:
+        """Enabled config modes that only AMRPipeline implements."""
+        return [name for name in ("stage_to_scratch", "stream_trimmed_reads",
+                                  "kmer_prefilter", "run_resfinder")
+                if getattr(self.config, name)]
+
+    # ------------------------------------------------------------------
+    # Helpers
+    # ------------------------------------------------------------------
+
+    def _emit(self, sample_id: str, step: str, status: str, detail: str = ""):
+        """Send a progress event to the registered callback."""
+        if self.progress_callback is None:
+            return
+        event = ProgressEvent(sample_id, step, status, time.time(), detail)
+        try:
+            self.progress_callback(event)
+        except Exception as e:
+            self.logger.error(f"Progress callback failed: {e}")
+
+    def _tool_semaphore(self, tool: str) -> asyncio.Semaphore:
+        """Return (creating on first use) the semaphore for a tool."""
+        if tool not in self._tool_semaphores:
+            self._tool_semaphores[tool] = asyncio.Semaphore(
+                self.tool_limits.get(tool, 1)
+            )
+        return self._tool_semaphores[tool]
+
+    async def _is_available(self, tool: str) -> bool:
+        """Check tool availability once per pipeline instance."""
+        if tool not in self._tool_available:
+            self._tool_available[tool] = await asyncio.to_thread(
+                check_tool_availability, tool
+            )
+        return self._tool_available[tool]
+
+    def _planned_threads(self, tool: str,
+                         inputs: List[Optional[Path]]) -> Optional[int]:
+        """Threads from the ResourcePlanner, or None to use config.threads."""
+        if not self.config.adaptive_resources:
+            return None
+        input_bytes = total_file_size(inputs)
+        n_files = sum(1 for p in inputs if p is not None)
+        return self.pipeline.planner.plan(tool, input_bytes, n_files).threads
+
+    async def _run_tool(self, tool: str, cmd: List[str],
+                        description: str) -> bool:
+        """Run a tool command under its concurrency limit."""
+        async with self._tool_semaphore(tool):
+            returncode, _, _ = await run_command_async(
+                cmd, self.logger, description
+            )
+        return returncode == 0
+
+    # ------------------------------------------------------------------
+    # Pipeline steps
+    # ------------------------------------------------------------------
+
+    async def run_fastqc(self, input_file: Path,
+                         output_dir: Optional[Path] = None) -> bool:
+        """Run FastQC on a single file."""
+        if not await self._is_available("fastqc"):
+            self.logger.warning("FastQC not found. Skipping QC step.")
+            return False
+
+        cmd = self.pipeline.qc.build_fastqc_command(
+            input_file, output_dir, self._planned_threads("fastqc", [input_file])
+        )
+        return await self._run_tool("fastqc", cmd, f"FastQC on {input_file.name}")
+
+    async def run_fastqc_batch(self, input_files: List[Path],
+                               output_dir: Optional[Path] = None) -> Dict[Path, bool]:
+        """Run FastQC over several files in one invocation."""
+        if not await self._is_available("fastqc"):
+            self.logger.warning("FastQC not found. Skipping QC step.")
+            return {f: False for f in input_files}
+
+        output_dir = output_dir or self.config.qc_reports_dir
+        cmd = self.pipeline.qc.build_fastqc_batch_command(
+            input_files, output_dir, self._planned_threads("fastqc", input_files)
+        )
+        await self._run_tool("fastqc", cmd, f"FastQC on {len(input_files)} files")
+
+        return {
+            f: self.pipeline.qc.fastqc_report_path(f, output_dir).exists()
+            for f in input_files
+        }
+
+    async def run_fastp(self, input_r1: Path,
+                        input_r2: Optional[Path] = None,
+                        output_prefix: Optional[str] = None) -> bool:
+        """Run fastp for quality trimming."""
+        if not await self._is_available("fastp"):
+            self.logger.warning("fastp not found. Skipping trimming step.")
+            return False
+
+        cmd = self.pipeline.trimmer.build_fastp_command(
+            input_r1, input_r2, output_prefix,
+            threads=self._planned_threads("fastp", [input_r1, input_r2])
+        )
+        return await self._run_tool(
+            "fastp", cmd, f"fastp trimming for {output_prefix}"
+        )
+
+    async def run_rgi_bwt(self, input_r1: Path,
+                          input_r2: Optional[Path] = None,
+                          output_prefix: Optional[str] = None) -> bool:
+        """Run RGI BWT for metagenomic ARG detection."""
+        if not await self._is_available("rgi"):
+            self.logger.warning("RGI not found. Skipping ARG annotation.")
+            return False
+
+        cmd = self.pipeline.annotator.build_rgi_bwt_command(
+            input_r1, input_r2, output_prefix,
+            self._planned_threads("rgi", [input_r1, input_r2])
+        )
+        return await self._run_tool(
+            "rgi", cmd, f"RGI BWT annotation for {output_prefix}"
+        )
+
+    # ------------------------------------------------------------------
+    # Orchestration
+    # ------------------------------------------------------------------
+
+    async def _process_sample_delegated(self,
+                                        sample_id: str,
+                                        r1_path: Path,
+                                        r2_path: Optional[Path] = None) -> dict:
+        """
+        Run a sample through AMRPipeline.process_sample in a worker thread.
+
+        Cancellation stops waiting for the sample, but tools that are
+        already running finish in the background thread.
+        """
+        self._emit(sample_id, "sample", "started")
+        try:
+            async with self._tool_semaphore("pipeline"):
+                self._emit(sample_id, "pipeline", "started",
+                           ", ".join(self.delegated_modes))
+                results = await asyncio.to_thread(
+                    self.pipeline.process_sample, sample_id, r1_path, r2_path
+                )
+        except asyncio.CancelledError:
+            self._emit(sample_id, "pipeline", "cancelled")
+            raise
+
+        self._emit(sample_id, "pipeline",
+                   "completed" if results.get("annotation_passed") else "failed")
+        self._emit(sample_id, "sample", "completed")
+        return results
+
+    async def process_sample(self,
+                             sample_id: str,
+                             r1_path: Path,
+                             r2_path: Optional[Path] = None) -> dict:
+        """Run full pipeline on a single sample."""
+        if self.delegated_modes:
+            return await self._process_sample_delegated(sample_id, r1_path, r2_path)
+
+        results = {
+            "sample_id": sample_id,
+            "qc_passed": False,
+            "trimming_passed": False,
+            "annotation_passed": False,
+            "arg_results": None
+        }
+
+        self._emit(sample_id, "sample", "started")
+        step = "qc"
+
+        try:
+            # Step 1: Initial QC (R1 and R2 in one FastQC invocation)
+            self._emit(sample_id, step, "started")
+            reads = [p for p in [r1_path, r2_path] if p]
+            qc_status = await self.run_fastqc_batch(reads)
+            results["qc_passed"] = qc_status[r1_path]
+            self._emit(sample_id, step,
+                       "completed" if results["qc_passed"] else "failed")
+
+            # Step 2: Trimming
+            step = "trimming"
+            self._emit(sample_id, step, "started")
+            results["trimming_passed"] = await self.run_fastp(
+                r1_path, r2_path, sample_id
+            )
+            self._emit(sample_id, step,
+                       "completed" if results["trimming_passed"] else "failed")
+
+            # Step 3: ARG Annotation
+            step = "annotation"
+            trimmed_r1 = self.config.trimmed_reads_dir / f"{sample_id}_trimmed_R1.fastq.gz"
+            trimmed_r2 = self.config.trimmed_reads_dir / f"{sample_id}_trimmed_R2.fastq.gz"
+
+            if trimmed_r1.exists():
+                self._emit(sample_id, step, "started")
+                results["annotation_passed"] = await self.run_rgi_bwt(
+                    trimmed_r1,
+                    trimmed_r2 if trimmed_r2.exists() else None,
+                    sample_id
+                )
+                self._emit(sample_id, step,
+                           "completed" if results["annotation_passed"] else "failed")
+
+                # Parse results off the event loop
+                step = "parsing"
+                result_file = self.config.arg_results_dir / sample_id
+                results["arg_results"] = await asyncio.to_thread(
+                    self.pipeline.annotator.parse_rgi_results, result_file
+                )
+            else:
+                self._emit(sample_id, step, "skipped", "trimmed reads not found")
+
+        except asyncio.CancelledError:
+            self._emit(sample_id, step, "cancelled")
+            raise
+
+        self._emit(sample_id, "sample", "completed")
+        return results
+
+    async def _bounded_sample(self, sample_id: str, r1_path: Path,
+                              r2_path: Optional[Path]) -> dict:
+        """Process a sample once a slot among active samples is free."""
+        async with self._sample_semaphore:
+            return await self.process_sample(sample_id, r1_path, r2_path)
+
+    async def process_samples(self,
+                              samples: List[Tuple[str, Path, Optional[Path]]]) -> List[dict]:
+        """
+        Process many samples concurrently on the running event loop.
+
+        Args:
+            samples: List of (sample_id, r1_path, r2_path)
+
+        Returns:
+            Per-sample result dicts in input order. Samples that were
+            cancelled or raised carry an "error" entry.
+        """
+        self._sample_semaphore = asyncio.Semaphore(self.max_active_samples)
+        self._tasks = [
+            asyncio.create_task(self._bounded_sample(sample_id, r1, r2),
+                                name=f"amr-sample-{sample_id}")
+            for sample_id, r1, r2 in samples
+        ]
+
+        outcomes = await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        all_results = []
+        for (sample_id, _, _), outcome in zip(samples, outcomes):
+            if isinstance(outcome, BaseException):
+                error = ("cancelled" if isinstance(outcome, asyncio.CancelledError)
+                         else str(outcome))
+                if error == "cancelled":
+                    self._emit(sample_id, "sample", "cancelled")
+                else:
+                    self.logger.error(f"Sample {sample_id} failed: {outcome}")
+                    self._emit(sample_id, "sample", "failed", error)
+                all_results.append({
+                    "sample_id": sample_id,
+                    "qc_passed": False,
+                    "trimming_passed": False,
+                    "annotation_passed": False,
+                    "arg_results": None,
+                    "error": error
+                })
+            else:
+                all_results.append(outcome)
+
+        return all_results
+
+    async def process_batch(self, manifest_file: Path) -> List[dict]:
+        """Process multiple samples from a manifest file."""
+        try:
+            samples = await asyncio.to_thread(
+                self.pipeline.load_manifest, manifest_file
+            )
+        except Exception as e:
+            self.logger.error(f"Error processing manifest: {e}")
+            samples = []
+
+        all_results = await self.process_samples(samples)
+
+        await asyncio.to_thread(self.pipeline.run_batch_multiqc)
+        await asyncio.to_thread(self.pipeline.generate_summary, all_results, manifest_file)
+
+        return all_results
+
+    def cancel(self) -> int:
+        """
+        Cancel all pending and running samples of the current batch.
+
+        Returns:
+            Number of sample tasks that were signalled
+        """
+        cancelled = 0
+        for task in self._tasks:
+            if not task.done():
+                task.cancel()
+                cancelled += 1
+
+        if cancelled:
+            self.logger.warning(f"Cancelling {cancelled} queued/running samples")
+        return cancelled
+
+
+# ============================================================================
+# ENTRY POINT
+# ============================================================================
+
+def main():
+    """Run the async pipeline over the default sample manifest."""
+    print("=" * 60)
+    print("AMR WASTEWATER THESIS - ASYNC PIPELINE")
+    print("=" * 60)
+
+    def print_progress(event: ProgressEvent):
+        print(f"  [{event.sample_id}] {event.step}: {event.status}")
+
+    config = PipelineConfig()
+    pipeline = AsyncAMRPipeline(config, progress_callback=print_progress)
+
+    manifest = Path("data/metadata/sample_manifest.tsv")
+    results = asyncio.run(pipeline.process_batch(manifest))
+
+    print(f"\nProcessed {len(results)} samples.")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+AMR Wastewater Thesis - Performance Benchmarks
+===============================================
+
+Lightweight benchmarks that guard performance budgets of the pipeline
+modules. Each benchmark prints its measurements and exits non-zero when
+a budget is exceeded, so it can run as a check before merging changes.
+
+Author: AMR Thesis Project
+Last Updated: 2026-10-18
+
+Usage:
+    python benchmarks.py import-time [--budget 1.0] [--repeats 5]
+    python benchmarks.py profile-memory [--samples 2000] [--max-ratio 0.3]
+    python benchmarks.py tool-limits
+"""
+
+import sys
+import json
+import argparse
+import random
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+PIPELINE_DIR = Path(__file__).resolve().parent
+
+# Dependencies that must not be loaded by a bare module import
+HEAVY_MODULES = ["scipy.stats", "scipy.spatial", "scipy.cluster", "sklearn"]
+
+
+# ============================================================================
+# IMPORT TIME
+# ============================================================================
+
+def _run_in_fresh_interpreter(code: str) -> str:
+    """Run Python code in a new interpreter from the pipeline directory."""
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=PIPELINE_DIR,
+        check=True
+    )
+    return result.stdout.strip()
+
+
+def measure_import_time(module: str = "ecological_analysis",
+                        repeats: int = 5) -> Dict[str, float]:
+    """
+    Time `import module` in fresh interpreters.
+
+    Returns:
+        Dictionary with min, median and max import time in seconds
+    """
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    timings = [float(_run_in_fresh_interpreter(code)) for _ in range(repeats)]
+
+    return {
+        "min": round(min(timings), 4),
+        "median": round(statistics.median(timings), 4),
+        "max": round(max(timings), 4)
+    }
+
+
+def heavy_modules_loaded(module: str = "ecological_analysis") -> List[str]:
+    """List HEAVY_MODULES that a bare import of module pulls in."""
+    code = (
+        f"import sys, json; import {module}; "
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    return json.loads(_run_in_fresh_interpreter(code))
+
+
+# ============================================================================
+# PROFILE MEMORY
+# ============================================================================
+
+def synthetic_rgi_results(n_samples: int, n_args: int = 6000,
+                          args_per_sample: int = 150,
+                          seed: int = 0) -> Iterator[dict]:
+    """
+    parse_rgi_results-style dictionaries with freshly built name strings,
+    as when each sample's output file is parsed separately.
+    """
+    rng = random.Random(seed)
+    n_classes, n_mechanisms = 40, 8
+    for i in range(n_samples):
+        yield {
+            "sample": f"SRR{i:08d}",
+            "arg_counts": {f"ARO:{3000000 + j}": rng.randint(1, 500)
+                           for j in rng.sample(range(n_args), args_per_sample)},
+            "drug_classes": {f"class {j} antibiotic": rng.randint(1, 500)
+                             for j in rng.sample(range(n_classes), 12)},
+            "mechanisms": {f"mechanism {j}": rng.randint(1, 50)
+                           for j in rng.sample(range(n_mechanisms), 5)},
+        }
+
+
+def _retained_bytes(build) -> Dict[str, int]:
+    """Memory still allocated after build() returns, and its peak."""
+    tracemalloc.start()
+    try:
+        result = build()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {"retained": current, "peak": peak}
+
+
+PROFILE_FORMS = ("dict", "columnar", "columnar_float32")
+
+
+def _profile_memory_in_process(form: str, n_samples: int, n_args: int = 6000,
+                               args_per_sample: int = 150) -> Dict[str, int]:
+    """Memory of a cohort held in one form, measured in this interpreter."""
+    import numpy as np
+    from ecological_analysis import ARGProfile, ProfileCollection
+
+    def cohort():
+        return synthetic_rgi_results(n_samples, n_args, args_per_sample)
+
+    dtype = np.float32 if form == "columnar_float32" else np.float64
+    # Warm-up so the lazy scipy.sparse import is not counted as retained
+    ProfileCollection.from_rgi_results(synthetic_rgi_results(1, n_args, 1), dtype=dtype)
+
+    if form == "dict":
+        return _retained_bytes(lambda: [
+            ARGProfile(r["sample"], r["arg_counts"], r["drug_classes"],
+                       r["mechanisms"], 0, 0)
+            for r in cohort()
+        ])
+    return _retained_bytes(lambda: ProfileCollection.from_rgi_results(cohort(), dtype=dtype))
+
+
+def measure_profile_memory(n_samples: int, n_args: int = 6000,
+                           args_per_sample: int = 150) -> Dict[str, Dict[str, int]]:
+    """
+    Memory of a cohort as ARGProfile dicts versus a ProfileCollection.
+
+    Each form is measured in a fresh interpreter: process-wide tables left
+    by an earlier measurement (such as the sys.intern table growing when it
+    is refilled) would otherwise be charged to whichever form runs next.
+    """
+    return {
+        form: json.loads(_run_in_fresh_interpreter(
+            "import json, benchmarks; print(json.dumps(benchmarks._profile_memory_in_process("
+            f"{form!r}, {n_samples}, {n_args}, {args_per_sample})))"
+        ))
+        for form in PROFILE_FORMS
+    }
+
+
+# ============================================================================
+# TOOL LIMITS
+# ============================================================================
+
+def adaptive_tool_limits() -> Dict[str, int]:
+    """
+    Concurrency limits of an AsyncAMRPipeline with adaptive resources.
+    
+    Every DEFAULT_TOOL_LIMITS key must be plannable by the ResourcePlanner
+    (directly or through PLANNED_AS), or construction raises.
+    """
+    from amr_pipeline import PipelineConfig
+    from async_pipeline import AsyncAMRPipeline
+    
+    with tempfile.TemporaryDirectory(prefix="amr_tool_limits_") as tmp:
+        base = Path(tmp)
+        config = PipelineConfig(
+            raw_reads_dir=base / "raw_reads",
+            trimmed_reads_dir=base / "trimmed_reads",
+            qc_reports_dir=base / "qc_reports",
+            arg_results_dir=base / "arg_annotation",
+            logs_dir=base / "logs",
+            adaptive_resources=True
+        )
+        return AsyncAMRPipeline(config).tool_limits
+
+
+# ============================================================================
+# ENTRY POINT
+# ============================================================================
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run a benchmark and compare it with its budget."""
+    parser = argparse.ArgumentParser(description="AMR pipeline benchmarks")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    import_time = benchmarks.add_parser("import-time",
+                                        help="Startup cost of a pipeline module")
+    import_time.add_argument("--module", default="ecological_analysis")
+    import_time.add_argument("--budget", type=float, default=1.0,
+                             help="Maximum median import time in seconds")
+    import_time.add_argument("--repeats", type=int, default=5)
+
+    profile_memory = benchmarks.add_parser("profile-memory",
+                                           help="ARGProfile dicts vs ProfileCollection")
+    profile_memory.add_argument("--samples", type=int, default=2000)
+    profile_memory.add_argument("--args", type=int, default=6000,
+                                help="ARG vocabulary size of the cohort (CARD scale)")
+    profile_memory.add_argument("--args-per-sample", type=int, default=150)
+    profile_memory.add_argument("--max-ratio", type=float, default=0.3,
+                                help="Maximum columnar / dict retained memory")
+    
+    benchmarks.add_parser("tool-limits",
+                          help="Async pipeline limits with adaptive resources")
+
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "import-time":
+        timings = measure_import_time(args.module, args.repeats)
+        loaded = heavy_modules_loaded(args.module)
+
+        print(f"import {args.module}: median {timings['median']:.3f}s "
+              f"(min {timings['min']:.3f}s, max {timings['max']:.3f}s), "
+              f"budget {args.budget:.3f}s")
+        if loaded:
+            print(f"✗ Heavy modules loaded at import: {', '.join(loaded)}")
+
+        return 0 if timings["median"] <= args.budget and not loaded else 1
+
+    if args.benchmark == "profile-memory":
+        usage = measure_profile_memory(args.samples, args.args, args.args_per_sample)
+        baseline = usage["dict"]["retained"]
+
+        print(f"{args.samples} samples, {args.args_per_sample} of {args.args} ARGs each")
+        for form, measured in usage.items():
+            print(f"  {form:<17} {measured['retained'] / 1e6:8.1f} MB retained "
+                  f"({measured['retained'] / args.samples / 1e3:.1f} kB/sample), "
+                  f"{measured['peak'] / 1e6:8.1f} MB peak, "
+                  f"ratio {measured['retained'] / baseline:.2f}")
+
+        ratio = usage["columnar"]["retained"] / baseline
+        return 0 if ratio <= args.max_ratio else 1
+    
+    if args.benchmark == "tool-limits":
+        try:
+            limits = adaptive_tool_limits()
+        except Exception as e:
+            print(f"✗ AsyncAMRPipeline with adaptive resources failed: {e!r}")
+            return 1
+        
+        print("adaptive tool limits: "
+              + ", ".join(f"{tool}={limit}" for tool, limit in limits.items()))
+        return 0 if all(limit >= 1 for limit in limits.values()) else 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,36 +10,74 @@ Last Updated: 2026-01-26
 
 Analysis Components:
 1. Alpha Diversity (Shannon, Simpson, Chao1)
-2. Beta Diversity (Bray-Curtis, Jaccard)
+2. Beta Diversity (Bray-Curtis, Jaccard, PCoA, NMDS)
 3. Differential Abundance (DESeq2-style, Wilcoxon)
-4. Visualization Utilities
+4. Category Rollups (drug class, mechanism, gene family)
+5. Visualization Utilities
 """
 
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
-from dataclasses import dataclass
+from typing import Iterable, List, Dict, Tuple, Optional
+from dataclasses import asdict, dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+import importlib
+import importlib.util
+import hashlib
 import json
+import os
+import sys
+import shutil
+import tempfile
 import warnings
 warnings.filterwarnings('ignore')
 
-# Conditional imports for optional dependencies
-try:
-    from scipy import stats
-    from scipy.spatial.distance import braycurtis, jaccard, pdist, squareform
-    from scipy.cluster.hierarchy import linkage, dendrogram
-    SCIPY_AVAILABLE = True
-except ImportError:
-    SCIPY_AVAILABLE = False
+# Optional dependencies are detected here but imported on first use, so
+# importing this module stays fast for short CLI and worker processes.
+SCIPY_AVAILABLE = importlib.util.find_spec("scipy") is not None
+SKLEARN_AVAILABLE = importlib.util.find_spec("sklearn") is not None
 
-try:
-    from sklearn.manifold import TSNE
-    from sklearn.decomposition import PCA
-    from sklearn.preprocessing import StandardScaler
-    SKLEARN_AVAILABLE = True
-except ImportError:
-    SKLEARN_AVAILABLE = False
+# Public names kept importable from this module: name -> (module, attribute)
+_LAZY_IMPORTS = {
+    "stats": ("scipy.stats", None),
+    "braycurtis": ("scipy.spatial.distance", "braycurtis"),
+    "jaccard": ("scipy.spatial.distance", "jaccard"),
+    "pdist": ("scipy.spatial.distance", "pdist"),
+    "squareform": ("scipy.spatial.distance", "squareform"),
+    "isotonic_regression": ("scipy.optimize", "isotonic_regression"),  # scipy >= 1.12
+    "linkage": ("scipy.cluster.hierarchy", "linkage"),
+    "dendrogram": ("scipy.cluster.hierarchy", "dendrogram"),
+    "fcluster": ("scipy.cluster.hierarchy", "fcluster"),
+    "leaves_list": ("scipy.cluster.hierarchy", "leaves_list"),
+    "cophenet": ("scipy.cluster.hierarchy", "cophenet"),
+    "sparse": ("scipy.sparse", None),
+    "TSNE": ("sklearn.manifold", "TSNE"),
+    "PCA": ("sklearn.decomposition", "PCA"),
+    "StandardScaler": ("sklearn.preprocessing", "StandardScaler"),
+}
+
+
+def _lazy(name: str):
+    """Import an optional dependency listed in _LAZY_IMPORTS on first use."""
+    if name in globals():
+        return globals()[name]
+    
+    module_name, attribute = _LAZY_IMPORTS[name]
+    value = importlib.import_module(module_name)
+    if attribute is not None:
+        value = getattr(value, attribute)
+    
+    globals()[name] = value  # later lookups skip __getattr__
+    return value
+
+
+def __getattr__(name: str):
+    """Resolve lazily imported names (PEP 562)."""
+    if name in _LAZY_IMPORTS:
+        return _lazy(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # ============================================================================
@@ -49,6 +87,9 @@ except ImportError:
 @dataclass
 class SampleMetadata:
     """Metadata for a wastewater sample."""
+    __slots__ = ("sample_id", "bioproject", "sample_type", "location",
+                 "country", "collection_date")
+    
     sample_id: str
     bioproject: str
     sample_type: str  # 'medical_influenced' or 'non_medical'
@@ -60,6 +101,9 @@ class SampleMetadata:
 @dataclass
 class ARGProfile:
     """ARG abundance profile for a sample."""
+    __slots__ = ("sample_id", "arg_counts", "drug_class_counts", "mechanism_counts",
+                 "total_reads", "arg_reads")
+    
     sample_id: str
     arg_counts: Dict[str, float]  # ARG name -> normalized abundance
     drug_class_counts: Dict[str, float]
@@ -68,6 +112,272 @@ class ARGProfile:
     arg_reads: int
 
 
+# ============================================================================
+# PROFILE COLLECTION (COLUMNAR)
+# ============================================================================
+
+class FeatureVocabulary:
+    """Interned feature names and their integer codes."""
+    
+    __slots__ = ("names", "_codes")
+    
+    def __init__(self, names: Iterable[str] = ()):
+        self.names: List[str] = []
+        self._codes: Dict[str, int] = {}
+        for name in names:
+            self.code(name)
+    
+    def code(self, name: str) -> int:
+        """Code of name, assigning the next code to a new name."""
+        code = self._codes.get(name)
+        if code is None:
+            code = len(self.names)
+            name = sys.intern(name)
+            self.names.append(name)
+            self._codes[name] = code
+        return code
+    
+    def __len__(self) -> int:
+        return len(self.names)
+    
+    def __getitem__(self, code: int) -> str:
+        return self.names[code]
+    
+    def __contains__(self, name: str) -> bool:
+        return name in self._codes
+    
+    def lookup(self, names: Iterable[str], default: int = -1) -> np.ndarray:
+        """Codes of names without assigning new ones (default if unknown)."""
+        return np.fromiter((self._codes.get(name, default) for name in names),
+                           dtype=np.int64)
+
+
+class ProfileCollection:
+    """
+    Many ARGProfiles stored column-wise.
+    
+    Each level (ARGs, drug classes, mechanisms) is one Samples x Features
+    CSR matrix over an interned vocabulary, instead of a dict per sample.
+    Memory grows with the number of detected ARGs, not with the vocabulary
+    (a CARD-sized vocabulary would make dense rows mostly zeros).
+    sparse_matrix() returns the stored matrix; matrix() and frame() build
+    dense arrays for BetaDiversity and DifferentialAbundance on request.
+    Metadata is a DataFrame with categorical columns.
+    """
+    
+    __slots__ = ("sample_ids", "vocabularies", "counts", "total_reads",
+                 "arg_reads", "metadata")
+    
+    # Level -> key in parse_rgi_results output, ARGProfile attribute
+    LEVELS = {
+        "arg": ("arg_counts", "arg_counts"),
+        "drug_class": ("drug_classes", "drug_class_counts"),
+        "mechanism": ("mechanisms", "mechanism_counts"),
+    }
+    
+    def __init__(self,
+                 sample_ids: List[str],
+                 vocabularies: Dict[str, FeatureVocabulary],
+                 counts: Dict[str, "sparse.csr_matrix"],
+                 total_reads: Optional[np.ndarray] = None,
+                 arg_reads: Optional[np.ndarray] = None,
+                 metadata: Optional[pd.DataFrame] = None):
+        self.sample_ids = [sys.intern(s) for s in sample_ids]
+        self.vocabularies = vocabularies
+        self.counts = counts
+        n = len(self.sample_ids)
+        self.total_reads = total_reads if total_reads is not None else np.zeros(n, dtype=np.int64)
+        self.arg_reads = arg_reads if arg_reads is not None else np.zeros(n, dtype=np.int64)
+        self.metadata = None
+        if metadata is not None:
+            self.set_metadata(metadata)
+    
+    @classmethod
+    def _build(cls, sample_ids: List[str],
+               entries: Iterable[Tuple[int, str, Dict[str, float]]],
+               dtype=np.float64, **kwargs) -> "ProfileCollection":
+        """
+        Assemble CSR count matrices from (sample index, level, {name: count}).
+        
+        sample_ids may still be filling while entries is consumed; it is
+        only read once entries is exhausted.
+        """
+        sparse = _lazy("sparse")
+        vocabularies = {level: FeatureVocabulary() for level in cls.LEVELS}
+        # Typed buffers keep the build from holding one Python object per cell
+        cells = {level: (array("i"), array("i"), array("d")) for level in cls.LEVELS}
+        
+        for row, level, feature_counts in entries:
+            vocabulary = vocabularies[level]
+            rows, codes, values = cells[level]
+            rows.extend([row] * len(feature_counts))
+            codes.extend(vocabulary.code(name) for name in feature_counts)
+            values.extend(feature_counts.values())
+        
+        counts = {}
+        for level, (rows, codes, values) in cells.items():
+            rows = np.frombuffer(rows, dtype=np.int32)
+            codes = np.frombuffer(codes, dtype=np.int32)
+            values = np.frombuffer(values, dtype=np.float64).astype(dtype)
+            if np.any(rows[1:] < rows[:-1]):
+                order = np.argsort(rows, kind="stable")
+                rows, codes, values = rows[order], codes[order], values[order]
+            
+            # Rows arrive in order and dictionary keys are unique, so the
+            # buffers already are CSR data and indices
+            indptr = np.zeros(len(sample_ids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(rows, minlength=len(sample_ids)), out=indptr[1:])
+            counts[level] = sparse.csr_matrix(
+                (values, codes.copy(), indptr),
+                shape=(len(sample_ids), len(vocabularies[level]))
+            )
+        
+        return cls(sample_ids, vocabularies, counts, **kwargs)
+    
+    @classmethod
+    def from_rgi_results(cls, results: Iterable[dict],
+                         metadata: Optional[pd.DataFrame] = None,
+                         dtype=np.float64) -> "ProfileCollection":
+        """
+        Build from parsed RGI output.
+        
+        Args:
+            results: ARGAnnotation.parse_rgi_results dictionaries, or
+                process_sample results (their 'arg_results' is used)
+            metadata: Optional sample metadata indexed by sample ID
+            dtype: Count dtype; float32 halves the stored values (the
+                int32 column indices stay the same size)
+        """
+        sample_ids = []
+        
+        # Consumed lazily so results can be a stream of parsed files
+        def entries():
+            for row, result in enumerate(results):
+                parsed = result.get("arg_results") or result
+                sample_ids.append(result.get("sample_id") or parsed.get("sample"))
+                for level, (key, _) in cls.LEVELS.items():
+                    yield row, level, parsed.get(key) or {}
+        
+        return cls._build(sample_ids, entries(), dtype, metadata=metadata)
+    
+    @classmethod
+    def from_summary(cls, summary_file: Path,
+                     metadata: Optional[pd.DataFrame] = None) -> "ProfileCollection":
+        """Build from the samples of a pipeline_summary.json."""
+        with open(summary_file, 'r') as f:
+            samples = json.load(f).get("samples", [])
+        return cls.from_rgi_results([s for s in samples if s.get("arg_results")], metadata)
+    
+    @classmethod
+    def from_profiles(cls, profiles: List[ARGProfile],
+                      metadata: Optional[List[SampleMetadata]] = None) -> "ProfileCollection":
+        """Build from ARGProfile (and SampleMetadata) objects."""
+        entries = [(row, level, getattr(profile, attribute))
+                   for row, profile in enumerate(profiles)
+                   for level, (_, attribute) in cls.LEVELS.items()]
+        
+        metadata_df = None
+        if metadata:
+            metadata_df = pd.DataFrame([asdict(m) for m in metadata]).set_index("sample_id")
+        
+        return cls._build(
+            [p.sample_id for p in profiles], entries,
+            total_reads=np.array([p.total_reads for p in profiles], dtype=np.int64),
+            arg_reads=np.array([p.arg_reads for p in profiles], dtype=np.int64),
+            metadata=metadata_df
+        )
+    
+    def set_metadata(self, metadata: pd.DataFrame):
+        """Align metadata to the samples and store text columns as categoricals."""
+        aligned = metadata.reindex(self.sample_ids)
+        for column in aligned.columns:
+            if aligned[column].dtype == object or pd.api.types.is_string_dtype(aligned[column]):
+                aligned[column] = aligned[column].astype("category")
+        self.metadata = aligned
+    
+    def __len__(self) -> int:
+        return len(self.sample_ids)
+    
+    def features(self, level: str = "arg") -> List[str]:
+        """Feature names in column order."""
+        return self.vocabularies[level].names
+    
+    def sparse_matrix(self, level: str = "arg"):
+        """Samples x Features CSR counts (the stored matrix, not a copy)."""
+        return self.counts[level]
+    
+    def matrix(self, level: str = "arg") -> np.ndarray:
+        """Samples x Features counts as a new dense array."""
+        return self.counts[level].toarray()
+    
+    def frame(self, level: str = "arg") -> pd.DataFrame:
+        """Features x Samples dense DataFrame of the counts."""
+        return pd.DataFrame(self.counts[level].T.toarray(), index=self.features(level),
+                            columns=self.sample_ids, copy=False)
+    
+    def _row(self, level: str, row: int) -> np.ndarray:
+        """Dense count vector of one sample."""
+        counts = self.counts[level]
+        start, stop = counts.indptr[row], counts.indptr[row + 1]
+        values = np.zeros(counts.shape[1], dtype=counts.dtype)
+        values[counts.indices[start:stop]] = counts.data[start:stop]
+        return values
+    
+    def sample_counts(self, sample_id: str, level: str = "arg") -> np.ndarray:
+        """Dense count vector of one sample."""
+        return self._row(level, self.sample_ids.index(sample_id))
+    
+    def to_profiles(self) -> List[ARGProfile]:
+        """Expand back to per-sample ARGProfile objects."""
+        def as_dict(level: str, row: int) -> Dict[str, float]:
+            counts = self.counts[level]
+            names = self.features(level)
+            start, stop = counts.indptr[row], counts.indptr[row + 1]
+            return {names[code]: float(value)
+                    for code, value in zip(counts.indices[start:stop], counts.data[start:stop])
+                    if value}
+        
+        return [
+            ARGProfile(
+                sample_id=sample_id,
+                arg_counts=as_dict("arg", row),
+                drug_class_counts=as_dict("drug_class", row),
+                mechanism_counts=as_dict("mechanism", row),
+                total_reads=int(self.total_reads[row]),
+                arg_reads=int(self.arg_reads[row])
+            )
+            for row, sample_id in enumerate(self.sample_ids)
+        ]
+    
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the count and read arrays."""
+        return (sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
+                    for m in self.counts.values())
+                + self.total_reads.nbytes + self.arg_reads.nbytes)
+    
+    def alpha_diversity(self, level: str = "arg") -> pd.DataFrame:
+        """AlphaDiversity.calculate_all for every sample (one dense row at a time)."""
+        alpha = AlphaDiversity()
+        return pd.DataFrame([alpha.calculate_all(self._row(level, row))
+                             for row in range(len(self))],
+                            index=self.sample_ids)
+    
+    def distance_matrix(self, metric: str = "braycurtis",
+                        level: str = "arg") -> pd.DataFrame:
+        """BetaDiversity.distance_matrix on the counts (densified for pdist)."""
+        return BetaDiversity().distance_matrix(self.matrix(level), self.sample_ids, metric)
+    
+    def compare_groups(self, group_column: str = "sample_type",
+                       level: str = "arg", **kwargs) -> pd.DataFrame:
+        """DifferentialAbundance.compare_groups using a metadata column."""
+        if self.metadata is None or group_column not in self.metadata.columns:
+            raise ValueError(f"No metadata column '{group_column}'")
+        return DifferentialAbundance().compare_groups(
+            self.frame(level), self.metadata[group_column].astype(object), **kwargs
+        )
+
+
 # ============================================================================
 # ALPHA DIVERSITY METRICS
 # ============================================================================
@@ -182,7 +492,7 @@ class BetaDiversity:
         sample1 = np.array(sample1, dtype=float)
         sample2 = np.array(sample2, dtype=float)
         
-        return braycurtis(sample1, sample2)
+        return _lazy("braycurtis")(sample1, sample2)
     
     @staticmethod
     def jaccard_distance(sample1: np.ndarray, sample2: np.ndarray) -> float:
@@ -190,11 +500,15 @@ class BetaDiversity:
         Calculate Jaccard distance (presence/absence).
         J = 1 - (|A ∩ B| / |A ∪ B|)
         """
-        # Convert to binary (presence/absence)
-        s1_binary = (np.array(sample1) > 0).astype(float)
-        s2_binary = (np.array(sample2) > 0).astype(float)
+        # Convert to binary (presence/absence) and count directly
+        s1_present = np.asarray(sample1) > 0
+        s2_present = np.asarray(sample2) > 0
+        
+        union = np.count_nonzero(s1_present | s2_present)
+        if union == 0:
+            return 0.0
         
-        return jaccard(s1_binary, s2_binary)
+        return 1.0 - np.count_nonzero(s1_present & s2_present) / union
     
     def distance_matrix(self, 
                         abundance_matrix: np.ndarray,
@@ -211,8 +525,8 @@ class BetaDiversity:
         Returns:
             Distance matrix as pandas DataFrame
         """
-        distances = pdist(abundance_matrix, metric=metric)
-        dist_matrix = squareform(distances)
+        distances = _lazy("pdist")(abundance_matrix, metric=metric)
+        dist_matrix = _lazy("squareform")(distances)
         
         return pd.DataFrame(
             dist_matrix,
@@ -220,6 +534,21 @@ class BetaDiversity:
             columns=sample_ids
         )
     
+    def presence_absence_distance_matrix(self,
+                                         abundance_matrix: np.ndarray,
+                                         sample_ids: List[str],
+                                         metric: str = "jaccard") -> pd.DataFrame:
+        """
+        Presence/absence distance matrix via the bit-packed engine.
+        
+        Args:
+            abundance_matrix: Samples x Features matrix
+            sample_ids: List of sample identifiers
+            metric: 'jaccard' or 'sorensen'
+        """
+        presence = PresenceAbsenceMatrix.from_matrix(abundance_matrix, sample_ids)
+        return presence.distance_dataframe(metric)
+    
     def pcoa(self, distance_matrix: pd.DataFrame, 
              n_components: int = 2) -> Tuple[pd.DataFrame, np.ndarray]:
         """
@@ -266,6 +595,599 @@ class BetaDiversity:
         )
         
         return coord_df, explained_variance
+    
+    def nmds(self,
+             distance_matrix: pd.DataFrame,
+             n_components: int = 2,
+             n_starts: int = 20,
+             seed: int = 0,
+             max_workers: Optional[int] = None,
+             max_iter: int = 300,
+             eps: float = 1e-5,
+             stress_tol: float = 1e-3,
+             min_repeats: int = 2,
+             scratch_dir: Optional[Path] = None) -> "NMDSResult":
+        """
+        Non-metric multidimensional scaling with parallel random starts.
+        
+        Each start runs non-metric SMACOF from a random configuration in a
+        process pool. Workers memory-map one shared copy of the distance
+        matrix. Starts are evaluated in seed order and the search stops once
+        the best stress has been reached min_repeats times (within stress_tol,
+        relative), so results are reproducible from seed for any pool size.
+        
+        Args:
+            distance_matrix: Square distance matrix (e.g. from distance_matrix())
+            n_starts: Maximum number of random starts
+            max_workers: Pool size (default: CPU count; 1 runs in-process)
+            eps: Relative stress improvement below which a start has converged
+            scratch_dir: Where the shared matrix is written (default: system temp)
+        
+        Returns:
+            NMDSResult with the best configuration and stress diagnostics
+        """
+        sample_ids = list(distance_matrix.index)
+        max_workers = max_workers or os.cpu_count() or 1
+        start_seeds = np.random.SeedSequence(seed).spawn(n_starts)
+        
+        work_dir = Path(tempfile.mkdtemp(prefix="nmds_", dir=scratch_dir))
+        matrix_path = work_dir / "distances.npy"
+        np.save(matrix_path, np.asarray(distance_matrix, dtype=float))
+        
+        runs = []
+        try:
+            jobs = [(matrix_path, n_components, start_seed, max_iter, eps)
+                    for start_seed in start_seeds]
+            
+            if max_workers == 1:
+                outcomes = (_nmds_single_start(*job) for job in jobs)
+                executor = None
+            else:
+                executor = ProcessPoolExecutor(max_workers=min(max_workers, n_starts))
+                futures = [executor.submit(_nmds_single_start, *job) for job in jobs]
+                outcomes = (future.result() for future in futures)
+            
+            try:
+                for outcome in outcomes:
+                    runs.append(outcome)
+                    if _nmds_repeats_of_best(runs, stress_tol) >= min_repeats:
+                        break
+            finally:
+                if executor is not None:
+                    executor.shutdown(wait=True, cancel_futures=True)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        
+        stresses = [stress for _, stress, _ in runs]
+        best = int(np.argmin(stresses))
+        repeats = _nmds_repeats_of_best(runs, stress_tol)
+        
+        return NMDSResult(
+            coordinates=pd.DataFrame(
+                _principal_axes(runs[best][0]),
+                index=sample_ids,
+                columns=[f"NMDS{i+1}" for i in range(n_components)]
+            ),
+            stress=stresses[best],
+            best_start=best,
+            converged=repeats >= min_repeats,
+            repeats_of_best=repeats,
+            stress_per_start=stresses,
+            iterations_per_start=[n_iter for _, _, n_iter in runs]
+        )
+    
+    @staticmethod
+    def condensed_distances(abundance_matrix: np.ndarray,
+                            metric: str = "braycurtis") -> np.ndarray:
+        """
+        Pairwise distances between rows in condensed (upper triangle) form.
+        
+        Pairs of all-zero rows, undefined for Bray-Curtis, are set to 0.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            distances = _lazy("pdist")(np.asarray(abundance_matrix, dtype=float),
+                                       metric=metric)
+        return np.nan_to_num(distances, nan=0.0)
+    
+    def cluster(self,
+                abundance_matrix: np.ndarray,
+                labels: List[str],
+                metric: str = "braycurtis",
+                method: str = "average",
+                optimal_ordering: Optional[bool] = None) -> "ClusterTree":
+        """
+        Hierarchical clustering of the rows of abundance_matrix.
+        
+        Works on the condensed distance vector throughout; the square
+        matrix is never built.
+        
+        Args:
+            metric: Any pdist metric ('braycurtis', 'jaccard', 'euclidean')
+            method: 'average' (UPGMA), 'complete' or 'ward'
+            optimal_ordering: Reorder leaves to minimize distances between
+                neighbours. Default: only up to
+                ClusterTree.OPTIMAL_ORDERING_MAX_LEAVES rows, since its cost
+                grows roughly cubically
+        """
+        return ClusterTree.build(self.condensed_distances(abundance_matrix, metric),
+                                 labels, method, metric, optimal_ordering)
+    
+    def cluster_distance_matrix(self,
+                                distance_matrix: pd.DataFrame,
+                                method: str = "average",
+                                optimal_ordering: Optional[bool] = None) -> "ClusterTree":
+        """Hierarchical clustering of a square matrix from distance_matrix()."""
+        condensed = _lazy("squareform")(np.asarray(distance_matrix, dtype=float),
+                                        checks=False)
+        return ClusterTree.build(condensed, list(distance_matrix.index),
+                                 method, "precomputed", optimal_ordering)
+    
+    def cluster_heatmap(self,
+                        abundance_df: pd.DataFrame,
+                        sample_metric: str = "braycurtis",
+                        feature_metric: str = "braycurtis",
+                        method: str = "average",
+                        optimal_ordering: Optional[bool] = None
+                        ) -> Tuple[pd.DataFrame, "ClusterTree", "ClusterTree"]:
+        """
+        Cluster samples and features of an abundance table for a heatmap.
+        
+        Args:
+            abundance_df: Features x Samples abundance matrix
+        
+        Returns:
+            ordered: abundance_df with rows and columns in leaf order
+            feature_tree: Tree over features (rows)
+            sample_tree: Tree over samples (columns)
+        """
+        values = abundance_df.to_numpy(dtype=float)
+        feature_tree = self.cluster(values, list(abundance_df.index),
+                                    feature_metric, method, optimal_ordering)
+        sample_tree = self.cluster(values.T, list(abundance_df.columns),
+                                   sample_metric, method, optimal_ordering)
+        
+        ordered = abundance_df.iloc[feature_tree.leaf_order, sample_tree.leaf_order]
+        return ordered, feature_tree, sample_tree
+
+
+# ============================================================================
+# HIERARCHICAL CLUSTERING
+# ============================================================================
+
+@dataclass
+class ClusterTree:
+    """
+    Linkage tree with leaf order, kept so it can be cut repeatedly.
+    
+    Cutting reuses the stored linkage matrix (linear in the number of
+    leaves) and memoizes each requested cut.
+    """
+    labels: List[str]
+    linkage_matrix: np.ndarray
+    method: str
+    metric: str
+    leaf_order: np.ndarray
+    cophenetic_correlation: float
+    _cuts: Dict[Tuple[str, float], pd.Series] = field(default_factory=dict, repr=False)
+    
+    METHODS = ("average", "complete", "ward")
+    OPTIMAL_ORDERING_MAX_LEAVES = 1000
+    
+    @classmethod
+    def build(cls, condensed: np.ndarray, labels: List[str], method: str,
+              metric: str, optimal_ordering: Optional[bool] = None) -> "ClusterTree":
+        """Link a condensed distance vector."""
+        if method not in cls.METHODS:
+            raise ValueError(f"Unknown linkage method: {method} (use {cls.METHODS})")
+        if len(labels) < 2:
+            raise ValueError("At least two observations are required for clustering")
+        
+        if optimal_ordering is None:
+            optimal_ordering = len(labels) <= cls.OPTIMAL_ORDERING_MAX_LEAVES
+        
+        linkage_matrix = _lazy("linkage")(condensed, method=method,
+                                          optimal_ordering=optimal_ordering)
+        correlation, _ = _lazy("cophenet")(linkage_matrix, condensed)
+        
+        return cls(
+            labels=list(labels),
+            linkage_matrix=linkage_matrix,
+            method=method,
+            metric=metric,
+            leaf_order=_lazy("leaves_list")(linkage_matrix),
+            cophenetic_correlation=float(correlation)
+        )
+    
+    @property
+    def leaves(self) -> List[str]:
+        """Labels in leaf (display) order."""
+        return [self.labels[i] for i in self.leaf_order]
+    
+    @property
+    def heights(self) -> np.ndarray:
+        """Merge heights, ascending."""
+        return self.linkage_matrix[:, 2]
+    
+    def cut(self, height: Optional[float] = None,
+            n_clusters: Optional[int] = None) -> pd.Series:
+        """
+        Flat clusters at a height or for a number of clusters.
+        
+        Returns:
+            Series mapping label to cluster number (1..k)
+        """
+        if (height is None) == (n_clusters is None):
+            raise ValueError("Specify exactly one of height or n_clusters")
+        
+        key = ("distance", float(height)) if height is not None \
+            else ("maxclust", float(n_clusters))
+        if key not in self._cuts:
+            assignments = _lazy("fcluster")(self.linkage_matrix, key[1], criterion=key[0])
+            self._cuts[key] = pd.Series(assignments, index=self.labels, name="cluster")
+        
+        return self._cuts[key]
+    
+    def dendrogram_data(self, **kwargs) -> Dict:
+        """Dendrogram coordinates for plotting (scipy dendrogram, no_plot)."""
+        return _lazy("dendrogram")(self.linkage_matrix, labels=self.labels,
+                                   no_plot=True, **kwargs)
+
+
+# ============================================================================
+# NMDS ORDINATION
+# ============================================================================
+
+@dataclass
+class NMDSResult:
+    """Best NMDS configuration with stress diagnostics over all starts."""
+    coordinates: pd.DataFrame
+    stress: float                   # Kruskal stress-1 of the best start
+    best_start: int
+    converged: bool                 # Best stress reached min_repeats times
+    repeats_of_best: int
+    stress_per_start: List[float] = field(default_factory=list)
+    iterations_per_start: List[int] = field(default_factory=list)
+    
+    @property
+    def n_starts(self) -> int:
+        return len(self.stress_per_start)
+    
+    @property
+    def nonmetric_r2(self) -> float:
+        """Non-metric fit R² of the Shepard diagram (1 - stress²)."""
+        return 1.0 - self.stress ** 2
+    
+    def diagnostics(self) -> Dict:
+        """Stress diagnostics as a JSON-serializable dictionary."""
+        return {
+            "stress": round(self.stress, 6),
+            "nonmetric_r2": round(self.nonmetric_r2, 6),
+            "best_start": self.best_start,
+            "n_starts": self.n_starts,
+            "converged": self.converged,
+            "repeats_of_best": self.repeats_of_best,
+            "stress_per_start": [round(v, 6) for v in self.stress_per_start],
+            "iterations_per_start": self.iterations_per_start
+        }
+
+
+def _isotonic_fit(values: np.ndarray) -> np.ndarray:
+    """Non-decreasing least-squares fit (pool adjacent violators)."""
+    try:
+        return _lazy("isotonic_regression")(values).x
+    except AttributeError:
+        pass  # scipy < 1.12
+    
+    means, weights = [], []
+    for value in values:
+        means.append(float(value))
+        weights.append(1)
+        while len(means) > 1 and means[-2] > means[-1]:
+            weight = weights[-2] + weights[-1]
+            means[-2] = (means[-2] * weights[-2] + means[-1] * weights[-1]) / weight
+            weights[-2] = weight
+            means.pop()
+            weights.pop()
+    return np.repeat(means, weights)
+
+
+def _nmds_single_start(matrix_path: Path, n_components: int,
+                       start_seed: np.random.SeedSequence,
+                       max_iter: int, eps: float) -> Tuple[np.ndarray, float, int]:
+    """
+    One non-metric SMACOF run from a random start (process pool worker).
+    
+    Returns:
+        (coordinates, stress-1, iterations)
+    """
+    dissimilarities = np.load(matrix_path, mmap_mode="r")
+    n = dissimilarities.shape[0]
+    upper = np.triu_indices(n, k=1)
+    order = np.argsort(dissimilarities[upper], kind="stable")
+    
+    rng = np.random.default_rng(start_seed)
+    coords = rng.uniform(-1.0, 1.0, size=(n, n_components))
+    
+    stress = previous = np.inf
+    iteration = 0
+    for iteration in range(1, max_iter + 1):
+        distances = _lazy("pdist")(coords)
+        
+        # Disparities: monotone regression of distances on dissimilarity rank
+        disparities = np.empty_like(distances)
+        disparities[order] = _isotonic_fit(distances[order])
+        disparities *= np.sqrt(len(distances) / max(np.sum(disparities ** 2), 1e-12))
+        
+        stress = np.sqrt(np.sum((distances - disparities) ** 2) /
+                         max(np.sum(distances ** 2), 1e-12))
+        if abs(previous - stress) < eps * previous:
+            break
+        previous = stress
+        
+        # Guttman transform
+        ratio = np.zeros(len(distances))
+        nonzero = distances > 0
+        ratio[nonzero] = disparities[nonzero] / distances[nonzero]
+        B = -_lazy("squareform")(ratio)
+        B[np.diag_indices(n)] = -B.sum(axis=1)
+        coords = B @ coords / n
+    
+    return coords, float(stress), iteration
+
+
+def _nmds_repeats_of_best(runs: List[Tuple[np.ndarray, float, int]],
+                          stress_tol: float) -> int:
+    """Number of runs whose stress is within stress_tol (relative) of the best."""
+    stresses = np.array([stress for _, stress, _ in runs])
+    best = stresses.min()
+    return int(np.count_nonzero(stresses - best <= stress_tol * max(best, 1e-12)))
+
+
+def _principal_axes(coords: np.ndarray) -> np.ndarray:
+    """Center a configuration and rotate it onto its principal axes."""
+    centered = coords - coords.mean(axis=0)
+    _, _, vt = np.linalg.svd(centered, full_matrices=False)
+    rotated = centered @ vt.T
+    # Fix sign so the largest loading of each axis is positive
+    signs = np.sign(rotated[np.abs(rotated).argmax(axis=0), range(rotated.shape[1])])
+    return rotated * np.where(signs == 0, 1, signs)
+
+
+# ============================================================================
+# PRESENCE/ABSENCE (BIT-PACKED)
+# ============================================================================
+
+if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+    def _row_popcount(words: np.ndarray) -> np.ndarray:
+        """Number of set bits per row, summed over the last axis."""
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    
+    def _row_popcount(words: np.ndarray) -> np.ndarray:
+        """Number of set bits per row, summed over the last axis."""
+        words = np.ascontiguousarray(words)
+        return _POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+class PresenceAbsenceMatrix:
+    """
+    ARG presence/absence per sample, packed 64 features per machine word.
+    
+    Shared-presence counts are popcounts of AND-ed words, so Jaccard and
+    Sørensen matrices, prevalence and core/accessory queries never build
+    float copies of the abundance table (1 bit instead of 64 per entry).
+    """
+    
+    # Upper bound on temporary memory per pairwise block
+    BLOCK_BYTES = 64 * 1024 ** 2
+    
+    def __init__(self, words: np.ndarray, n_features: int,
+                 sample_ids: List[str], feature_ids: Optional[List[str]] = None):
+        """
+        Args:
+            words: Samples x ceil(n_features / 64) uint64 bitsets
+            n_features: Number of features represented by the bits
+            sample_ids: Row labels
+            feature_ids: Feature labels (default: positional indices)
+        """
+        self.words = words
+        self.n_features = n_features
+        self.sample_ids = list(sample_ids)
+        self.feature_ids = (list(feature_ids) if feature_ids is not None
+                            else list(range(n_features)))
+        self._sample_index = {s: i for i, s in enumerate(self.sample_ids)}
+        self._richness: Optional[np.ndarray] = None
+    
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, sample_ids: List[str],
+                    feature_ids: Optional[List[str]] = None,
+                    threshold: float = 0.0) -> "PresenceAbsenceMatrix":
+        """Pack a Samples x Features abundance matrix (present = > threshold)."""
+        matrix = np.asarray(matrix)
+        n_samples, n_features = matrix.shape
+        n_bytes = -(-n_features // 64) * 8
+        
+        packed = np.zeros((n_samples, n_bytes), dtype=np.uint8)
+        # Pack in row chunks so the boolean temporary stays small
+        chunk = max(1, cls.BLOCK_BYTES // max(n_features, 1))
+        for start in range(0, n_samples, chunk):
+            present = matrix[start:start + chunk] > threshold
+            bits = np.packbits(present, axis=1, bitorder="little")
+            packed[start:start + chunk, :bits.shape[1]] = bits
+        
+        return cls(packed.view(np.uint64), n_features, sample_ids, feature_ids)
+    
+    @classmethod
+    def from_abundance(cls, abundance_df: pd.DataFrame,
+                       threshold: float = 0.0) -> "PresenceAbsenceMatrix":
+        """Pack a Features x Samples abundance table (the layout used elsewhere)."""
+        return cls.from_matrix(abundance_df.values.T, list(abundance_df.columns),
+                               list(abundance_df.index), threshold)
+    
+    @property
+    def n_samples(self) -> int:
+        return len(self.sample_ids)
+    
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the packed bits."""
+        return self.words.nbytes
+    
+    def to_dense(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Unpack (a subset of) rows to a boolean Samples x Features array."""
+        words = self.words if rows is None else self.words[rows]
+        bits = np.unpackbits(words.view(np.uint8), axis=1,
+                             count=self.n_features, bitorder="little")
+        return bits.astype(bool)
+    
+    # ------------------------------------------------------------------
+    # Per-sample and per-feature counts
+    # ------------------------------------------------------------------
+    
+    def richness(self) -> np.ndarray:
+        """Number of features present in each sample."""
+        if self._richness is None:
+            self._richness = _row_popcount(self.words)
+        return self._richness
+    
+    def prevalence(self, samples: Optional[List[str]] = None) -> pd.Series:
+        """Number of samples (optionally a subset) in which each feature is present."""
+        rows = self._rows(samples)
+        counts = np.zeros(self.n_features, dtype=np.int64)
+        
+        chunk = max(1, self.BLOCK_BYTES // max(self.n_features, 1))
+        for start in range(0, len(rows), chunk):
+            counts += self.to_dense(rows[start:start + chunk]).sum(axis=0)
+        
+        return pd.Series(counts, index=self.feature_ids, name="prevalence")
+    
+    def _rows(self, samples: Optional[List[str]]) -> np.ndarray:
+        """Row indices for sample IDs (all rows if None)."""
+        if samples is None:
+            return np.arange(self.n_samples)
+        return np.array([self._sample_index[s] for s in samples], dtype=np.int64)
+    
+    # ------------------------------------------------------------------
+    # Pairwise counts and distances
+    # ------------------------------------------------------------------
+    
+    def _intersection_blocks(self):
+        """
+        Shared-feature counts of the upper triangle, one row block at a time.
+        
+        Yields:
+            (start, stop, counts) where counts[i, j] is shared between
+            samples start + i and start + j, for rows start:stop
+        """
+        n, n_words = self.words.shape
+        block = max(1, self.BLOCK_BYTES // max(n * n_words * 8, 1))
+        for start in range(0, n, block):
+            stop = min(start + block, n)
+            yield start, stop, _row_popcount(
+                self.words[start:stop, None, :] & self.words[None, start:, :]
+            )
+    
+    def intersection_counts(self) -> np.ndarray:
+        """Samples x Samples matrix of shared-feature counts."""
+        n = self.n_samples
+        shared = np.empty((n, n), dtype=np.int64)
+        for start, stop, counts in self._intersection_blocks():
+            shared[start:stop, start:] = counts
+            shared[start:, start:stop] = counts.T
+        return shared
+    
+    def distance_matrix(self, metric: str = "jaccard",
+                        dtype=np.float32, condensed: bool = False) -> np.ndarray:
+        """
+        Pairwise presence/absence distances.
+        
+        Jaccard:  1 - |A ∩ B| / |A ∪ B|
+        Sørensen: 1 - 2|A ∩ B| / (|A| + |B|)
+        Two empty samples have distance 0.
+        
+        Distances are computed per row block and written into a single
+        output, so memory is the output plus BLOCK_BYTES-sized temporaries
+        (a float32 square matrix is 1.6 GB at 20,000 samples, the condensed
+        form half of that).
+        
+        Args:
+            dtype: Output dtype
+            condensed: Return the condensed upper triangle (pdist layout)
+        """
+        if metric not in ("jaccard", "sorensen", "dice"):
+            raise ValueError(f"Unknown presence/absence metric: {metric}")
+        
+        n = self.n_samples
+        richness = self.richness().astype(float)
+        out = np.zeros(n * (n - 1) // 2 if condensed else (n, n), dtype=dtype)
+        
+        for start, stop, shared in self._intersection_blocks():
+            shared = shared.astype(float)
+            total = richness[start:stop, None] + richness[None, start:]
+            if metric == "jaccard":
+                denominator = total - shared
+                numerator = shared
+            else:
+                denominator = total
+                numerator = 2 * shared
+            with np.errstate(invalid="ignore", divide="ignore"):
+                distances = 1.0 - numerator / denominator
+            distances[denominator == 0] = 0.0
+            
+            if condensed:
+                for i in range(start, stop):
+                    offset = i * n - i * (i + 1) // 2
+                    out[offset:offset + n - i - 1] = distances[i - start, i - start + 1:]
+            else:
+                out[start:stop, start:] = distances
+                out[start:, start:stop] = distances.T
+        
+        if not condensed:
+            np.fill_diagonal(out, 0.0)
+        return out
+    
+    def distance_dataframe(self, metric: str = "jaccard") -> pd.DataFrame:
+        """Distance matrix labelled by sample ID, as BetaDiversity returns."""
+        return pd.DataFrame(self.distance_matrix(metric),
+                            index=self.sample_ids, columns=self.sample_ids)
+    
+    # ------------------------------------------------------------------
+    # Shared ARG set queries
+    # ------------------------------------------------------------------
+    
+    def shared_features(self, sample_a: str, sample_b: str) -> List:
+        """Features present in both samples."""
+        a = self.words[self._sample_index[sample_a]]
+        b = self.words[self._sample_index[sample_b]]
+        return self._features_from_words(a & b)
+    
+    def core_features(self, min_fraction: float = 1.0,
+                      samples: Optional[List[str]] = None) -> List:
+        """Features present in at least min_fraction of the (selected) samples."""
+        rows = self._rows(samples)
+        if min_fraction >= 1.0:
+            # Pure bitwise AND across samples
+            core = np.bitwise_and.reduce(self.words[rows], axis=0)
+            return self._features_from_words(core)
+        
+        prevalence = self.prevalence(samples).values
+        mask = prevalence >= min_fraction * len(rows)
+        return [f for f, keep in zip(self.feature_ids, mask) if keep]
+    
+    def accessory_features(self, min_fraction: float = 1.0,
+                           samples: Optional[List[str]] = None) -> List:
+        """Features present in some (selected) samples but below the core threshold."""
+        rows = self._rows(samples)
+        prevalence = self.prevalence(samples).values
+        mask = (prevalence > 0) & (prevalence < min_fraction * len(rows))
+        return [f for f, keep in zip(self.feature_ids, mask) if keep]
+    
+    def _features_from_words(self, words: np.ndarray) -> List:
+        """Feature IDs for the set bits of one packed row."""
+        bits = np.unpackbits(words.view(np.uint8), count=self.n_features,
+                             bitorder="little")
+        return [self.feature_ids[i] for i in np.flatnonzero(bits)]
 
 
 # ============================================================================
@@ -290,7 +1212,7 @@ class DifferentialAbundance:
             statistic: U statistic
             p_value: Two-sided p-value
         """
-        statistic, p_value = stats.mannwhitneyu(
+        statistic, p_value = _lazy("stats").mannwhitneyu(
             group1, group2, 
             alternative='two-sided'
         )
@@ -383,6 +1305,312 @@ class DifferentialAbundance:
         return result_df
 
 
+# ============================================================================
+# CATEGORY ROLLUPS (SPARSE)
+# ============================================================================
+
+class CategoryRollup:
+    """
+    ARG -> drug class, mechanism and gene family rollups as one sparse product.
+    
+    RGI joins the categories of multi-class ARGs with ';'. Each ARG row of
+    the indicator matrix marks every category it belongs to, with the
+    levels side by side as column blocks, so one sparse product with an
+    ARGs x Samples table gives the totals of all levels for all samples.
+    Under 'membership' weighting a multi-class ARG counts fully towards each
+    of its classes (level totals can exceed the ARG total); 'fractional'
+    splits it evenly between them. ARGs without annotation count as Unknown.
+    
+    Annotations of a whole CARD release are read from its aro_index.tsv;
+    cached() builds that matrix once per release and keeps it in
+    PipelineConfig.rollup_cache_dir. Without CARD data, from_annotations()
+    builds one for the ARGs of a batch (see ARGAnnotation.parse_rgi_results).
+    """
+    
+    LEVELS = ("drug_class", "mechanism", "family")
+    WEIGHTINGS = ("membership", "fractional")
+    CACHE_VERSION = 2
+    
+    # CARD index of all ARGs: name column, level -> category column
+    ARO_INDEX = "aro_index.tsv"
+    ARO_NAME_COLUMN = "ARO Name"
+    ARO_INDEX_COLUMNS = {
+        "drug_class": "Drug Class",
+        "mechanism": "Resistance Mechanism",
+        "family": "AMR Gene Family",
+    }
+    
+    # (cache key, rollup) last built or loaded by this process. One CARD
+    # release is in use at a time, so long-lived workers hold one matrix.
+    _loaded: Optional[Tuple[str, "CategoryRollup"]] = None
+    
+    def __init__(self,
+                 args: List[str],
+                 categories: Dict[str, List[str]],
+                 rows: np.ndarray,
+                 cols: np.ndarray,
+                 shares: np.ndarray):
+        """
+        Args:
+            args: ARG names; row len(args) is the Unknown row for others
+            categories: Level -> category names, in column block order
+            rows, cols: Coordinates of the ARG/category memberships
+            shares: 1 / number of categories of the ARG at that level
+        """
+        self.args = FeatureVocabulary(args)
+        self.categories = categories
+        self.levels = tuple(categories)
+        
+        self.blocks: Dict[str, Tuple[int, int]] = {}
+        start = 0
+        for level, names in categories.items():
+            self.blocks[level] = (start, start + len(names))
+            start += len(names)
+        
+        sparse = _lazy("sparse")
+        shape = (len(args) + 1, start)
+        self.rows, self.cols, self.shares = rows, cols, shares
+        self._matrices = {
+            "membership": sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape),
+            "fractional": sparse.csr_matrix((shares, (rows, cols)), shape=shape),
+        }
+    
+    @classmethod
+    def from_annotations(cls, annotations: Dict[str, Dict[str, str]],
+                         levels: Iterable[str] = LEVELS) -> "CategoryRollup":
+        """
+        Build the indicator matrices.
+        
+        Args:
+            annotations: ARG -> {level: ';'-joined categories}
+            levels: Levels to build; missing values count as Unknown
+        """
+        from amr_pipeline import ARGAnnotation
+        
+        levels = tuple(levels)
+        args = list(annotations)
+        memberships = {
+            level: [ARGAnnotation.split_categories(annotations[arg].get(level)) for arg in args]
+                   + [[ARGAnnotation.UNKNOWN]]
+            for level in levels
+        }
+        
+        categories, rows, cols, shares = {}, [], [], []
+        offset = 0
+        for level in levels:
+            names = sorted({name for member in memberships[level] for name in member})
+            codes = {name: offset + code for code, name in enumerate(names)}
+            for row, member in enumerate(memberships[level]):
+                rows.extend([row] * len(member))
+                cols.extend(codes[name] for name in member)
+                shares.extend([1.0 / len(member)] * len(member))
+            categories[level] = names
+            offset += len(names)
+        
+        return cls(args, categories,
+                   np.array(rows, dtype=np.int64),
+                   np.array(cols, dtype=np.int64),
+                   np.array(shares, dtype=np.float64))
+    
+    @classmethod
+    def from_arg_to_class(cls, arg_to_class: Dict[str, str]) -> "CategoryRollup":
+        """Drug class rollup from a plain ARG -> drug class map."""
+        return cls.from_annotations({arg: {"drug_class": drug_class}
+                                     for arg, drug_class in arg_to_class.items()},
+                                    levels=("drug_class",))
+    
+    @classmethod
+    def aro_index_path(cls, card_db_path: Path) -> Path:
+        """aro_index.tsv of a CARD data directory (or of a file's directory)."""
+        card_db_path = Path(card_db_path)
+        if card_db_path.is_file():
+            card_db_path = card_db_path.parent
+        return card_db_path / cls.ARO_INDEX
+    
+    @classmethod
+    def read_aro_index(cls, card_db_path: Path) -> Dict[str, Dict[str, str]]:
+        """ARG name -> {level: ';'-joined categories} for a CARD release."""
+        index = pd.read_csv(cls.aro_index_path(card_db_path), sep='\t', dtype=str,
+                            usecols=[cls.ARO_NAME_COLUMN, *cls.ARO_INDEX_COLUMNS.values()])
+        index = index.drop_duplicates(cls.ARO_NAME_COLUMN).set_index(cls.ARO_NAME_COLUMN)
+        index = index.rename(columns={column: level
+                                      for level, column in cls.ARO_INDEX_COLUMNS.items()})
+        return index.to_dict(orient="index")
+    
+    @classmethod
+    def cache_key(cls, card_db_path: Path, levels: Iterable[str] = LEVELS) -> str:
+        """Key of a CARD release: path, size and mtime of its aro_index.tsv."""
+        aro_index = cls.aro_index_path(card_db_path).resolve()
+        stat = aro_index.stat()
+        payload = json.dumps([cls.CACHE_VERSION, list(levels), str(aro_index),
+                              stat.st_size, stat.st_mtime_ns])
+        return hashlib.sha256(payload.encode()).hexdigest()[:20]
+    
+    @classmethod
+    def cached(cls, card_db_path: Path, cache_dir: Path,
+               levels: Iterable[str] = LEVELS) -> "CategoryRollup":
+        """
+        Rollup over all ARGs of a CARD release, built once and reused.
+        
+        Matrices are stored as cache_dir/rollup_<key>.npz. A new release (or
+        an updated aro_index.tsv) gets a new key, and its file replaces the
+        older ones, so the cache holds one matrix.
+        """
+        levels = tuple(levels)
+        key = cls.cache_key(card_db_path, levels)
+        if cls._loaded is not None and cls._loaded[0] == key:
+            return cls._loaded[1]
+        
+        cache_dir = Path(cache_dir)
+        cache_file = cache_dir / f"rollup_{key}.npz"
+        rollup = None
+        if cache_file.exists():
+            try:
+                rollup = cls.load(cache_file)
+            except (OSError, ValueError, KeyError) as e:
+                warnings.warn(f"Ignoring unreadable rollup cache {cache_file}: {e}")
+        
+        if rollup is None:
+            rollup = cls.from_annotations(cls.read_aro_index(card_db_path), levels)
+            try:
+                rollup.save(cache_file)
+                for stale in cache_dir.glob("rollup_*.npz"):
+                    if stale != cache_file:
+                        stale.unlink()
+            except OSError as e:
+                warnings.warn(f"Could not write rollup cache {cache_file}: {e}")
+        
+        cls._loaded = (key, rollup)
+        return rollup
+    
+    @classmethod
+    def from_summary(cls, summary_file: Path,
+                     levels: Iterable[str] = LEVELS) -> "CategoryRollup":
+        """
+        Rollup for the samples of a pipeline_summary.json.
+        
+        Uses the CARD release recorded as its 'card_db_path', cached in the
+        PipelineConfig.rollup_cache_dir of the summary's arg_results_dir;
+        otherwise the merged 'arg_annotations' of its samples.
+        """
+        from amr_pipeline import PipelineConfig
+        
+        summary_file = Path(summary_file)
+        with open(summary_file, 'r') as f:
+            summary = json.load(f)
+        
+        card_db_path = summary.get("card_db_path")
+        if card_db_path and cls.aro_index_path(card_db_path).exists():
+            cache_dir = PipelineConfig(arg_results_dir=summary_file.parent).rollup_cache_dir
+            return cls.cached(card_db_path, cache_dir, levels)
+        
+        annotations = summary.get("arg_annotations")
+        if not annotations:
+            raise ValueError(f"No CARD data or ARG annotations in {summary_file}")
+        return cls.from_annotations(annotations, levels)
+    
+    def save(self, path: Path):
+        """Write the matrices to an .npz file (atomically replaced)."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {
+            "args": np.array(self.args.names, dtype=str),
+            "levels": np.array(self.levels, dtype=str),
+            "rows": self.rows,
+            "cols": self.cols,
+            "shares": self.shares,
+        }
+        for level, names in self.categories.items():
+            arrays[f"categories_{level}"] = np.array(names, dtype=str)
+        
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".npz.tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_name, path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+    
+    @classmethod
+    def load(cls, path: Path) -> "CategoryRollup":
+        """Read matrices written by save()."""
+        with np.load(path, allow_pickle=False) as data:
+            categories = {level: data[f"categories_{level}"].tolist()
+                          for level in data["levels"].tolist()}
+            return cls(data["args"].tolist(), categories,
+                       data["rows"], data["cols"], data["shares"])
+    
+    def matrix(self, weighting: str = "membership"):
+        """(ARGs + Unknown row) x Categories CSR indicator matrix."""
+        if weighting not in self._matrices:
+            raise ValueError(f"Unknown weighting: {weighting}. Use one of {self.WEIGHTINGS}")
+        return self._matrices[weighting]
+    
+    def rollup_values(self, values: np.ndarray, arg_names: Iterable[str],
+                      levels: Optional[Iterable[str]] = None,
+                      weighting: str = "membership") -> Dict[str, Tuple[List[str], np.ndarray]]:
+        """
+        Category totals of an ARGs x Samples array.
+        
+        Returns:
+            Level -> (categories, Categories x Samples totals), keeping only
+            categories of at least one of arg_names
+        """
+        levels = self.levels if levels is None else tuple(levels)
+        codes = self.args.lookup(arg_names, default=len(self.args))
+        selected = self.matrix(weighting)[codes]
+        
+        # All levels in one product; indicator.T @ values
+        totals = selected.T @ values
+        if hasattr(totals, "toarray"):  # sparse values (ProfileCollection)
+            totals = totals.toarray()
+        if weighting == "membership" and np.issubdtype(values.dtype, np.integer):
+            totals = totals.astype(values.dtype)
+        used = np.diff(selected.tocsc().indptr) > 0
+        
+        rollups = {}
+        for level in levels:
+            start, stop = self.blocks[level]
+            keep = np.flatnonzero(used[start:stop])
+            rollups[level] = ([self.categories[level][i] for i in keep],
+                              totals[start + keep])
+        return rollups
+    
+    def rollup_all(self, abundance_df: pd.DataFrame,
+                   levels: Optional[Iterable[str]] = None,
+                   weighting: str = "membership") -> Dict[str, pd.DataFrame]:
+        """Level -> Categories x Samples table for an ARGs x Samples table."""
+        values = abundance_df.to_numpy()
+        if not np.issubdtype(values.dtype, np.number):
+            values = values.astype(float)
+        
+        return {
+            level: pd.DataFrame(totals, index=pd.Index(names, name=level),
+                                columns=abundance_df.columns)
+            for level, (names, totals) in self.rollup_values(
+                values, abundance_df.index, levels, weighting
+            ).items()
+        }
+    
+    def rollup(self, abundance_df: pd.DataFrame, level: str = "drug_class",
+               weighting: str = "membership") -> pd.DataFrame:
+        """Categories x Samples table of one level."""
+        return self.rollup_all(abundance_df, [level], weighting)[level]
+    
+    def rollup_collection(self, collection: "ProfileCollection",
+                          levels: Optional[Iterable[str]] = None,
+                          weighting: str = "membership") -> Dict[str, pd.DataFrame]:
+        """rollup_all on the sparse ARG counts of a ProfileCollection."""
+        return {
+            level: pd.DataFrame(totals, index=pd.Index(names, name=level),
+                                columns=collection.sample_ids)
+            for level, (names, totals) in self.rollup_values(
+                collection.sparse_matrix("arg").T, collection.features("arg"), levels, weighting
+            ).items()
+        }
+
+
 # ============================================================================
 # ABUNDANCE TABLE UTILITIES
 # ============================================================================
@@ -410,12 +1638,17 @@ class AbundanceTable:
     
     @staticmethod
     def aggregate_by_drug_class(arg_df: pd.DataFrame,
-                                 arg_to_class: Dict[str, str]) -> pd.DataFrame:
-        """Aggregate ARG abundance by antibiotic drug class."""
-        arg_df = arg_df.copy()
-        arg_df["drug_class"] = arg_df.index.map(arg_to_class).fillna("Unknown")
+                                 arg_to_class: Dict[str, str],
+                                 weighting: str = "membership") -> pd.DataFrame:
+        """
+        Aggregate ARG abundance by antibiotic drug class.
         
-        return arg_df.groupby("drug_class").sum()
+        ';'-joined classes are split, so a multi-class ARG counts towards
+        each of its classes (see CategoryRollup for weighting).
+        """
+        return CategoryRollup.from_arg_to_class(arg_to_class).rollup(
+            arg_df, "drug_class", weighting
+        )
     
     @staticmethod
     def filter_low_abundance(abundance_df: pd.DataFrame,
@@ -429,8 +1662,8 @@ class AbundanceTable:
             min_prevalence: Minimum fraction of samples with presence
             min_abundance: Minimum mean abundance across samples
         """
-        # Prevalence filter
-        prevalence = (abundance_df > 0).sum(axis=1) / abundance_df.shape[1]
+        # Prevalence filter (counted directly, no float presence table)
+        prevalence = np.count_nonzero(abundance_df.values > 0, axis=1) / abundance_df.shape[1]
         prevalence_mask = prevalence >= min_prevalence
         
         # Abundance filter
@@ -457,13 +1690,19 @@ class EcologicalAnalysis:
     
     def run_full_analysis(self,
                           abundance_file: Path,
-                          metadata_file: Path) -> Dict:
+                          metadata_file: Path,
+                          rollup: Optional[CategoryRollup] = None,
+                          summary_file: Optional[Path] = None) -> Dict:
         """
         Run complete ecological analysis pipeline.
         
         Args:
             abundance_file: Path to ARG abundance table (TSV/CSV)
             metadata_file: Path to sample metadata (TSV/CSV)
+            rollup: Optional CategoryRollup; its level tables are saved
+                and tested along the spatial gradient
+            summary_file: pipeline_summary.json to build the rollup from
+                when none is given
         
         Returns:
             Dictionary with all analysis results
@@ -473,7 +1712,7 @@ class EcologicalAnalysis:
         print("=" * 60)
         
         # Load data
-        print("\n[1/5] Loading data...")
+        print("\n[1/6] Loading data...")
         abundance_df = pd.read_csv(abundance_file, sep='\t', index_col=0)
         metadata_df = pd.read_csv(metadata_file, sep='\t', index_col=0)
         
@@ -482,8 +1721,18 @@ class EcologicalAnalysis:
             "features_analyzed": len(abundance_df.index)
         }
         
+        # Drug class / mechanism / family tables (one sparse product)
+        if rollup is None and summary_file is not None:
+            rollup = CategoryRollup.from_summary(summary_file)
+        if rollup is not None:
+            category_tables = rollup.rollup_all(abundance_df)
+            for level, table in category_tables.items():
+                table.to_csv(self.output_dir / f"abundance_by_{level}.tsv", sep='\t')
+            results["category_rollups"] = {level: len(table)
+                                           for level, table in category_tables.items()}
+        
         # Alpha diversity
-        print("[2/5] Calculating alpha diversity...")
+        print("[2/6] Calculating alpha diversity...")
         alpha_results = {}
         for sample in abundance_df.columns:
             counts = abundance_df[sample].values
@@ -493,7 +1742,7 @@ class EcologicalAnalysis:
         
         # Beta diversity
         if self.beta:
-            print("[3/5] Calculating beta diversity...")
+            print("[3/6] Calculating beta diversity...")
             dist_matrix = self.beta.distance_matrix(
                 abundance_df.T.values,
                 list(abundance_df.columns),
@@ -509,7 +1758,7 @@ class EcologicalAnalysis:
         
         # Differential abundance
         if self.diff_abundance and "sample_type" in metadata_df.columns:
-            print("[4/5] Differential abundance analysis...")
+            print("[4/6] Differential abundance analysis...")
             group_labels = metadata_df["sample_type"]
             diff_results = self.diff_abundance.compare_groups(
                 abundance_df,
@@ -517,8 +1766,18 @@ class EcologicalAnalysis:
             )
             results["differential_abundance"] = diff_results.to_dict(orient="records")
         
+        # Spatial gradient (upstream -> catchment -> downstream)
+        if "zone" in metadata_df.columns:
+            from spatial_gradient import GradientAnalysis
+            gradient = GradientAnalysis()
+            zones = gradient.select_zones(metadata_df["zone"])
+            if zones.nunique() >= 2:
+                print("[5/6] Spatial gradient trend tests...")
+                gradient_results = gradient.analyze(abundance_df, zones, rollup=rollup)
+                results["spatial_gradient"] = gradient_results.to_dict(orient="records")
+        
         # Save results
-        print("[5/5] Saving results...")
+        print("[6/6] Saving results...")
         output_file = self.output_dir / "ecological_analysis_results.json"
         with open(output_file, 'w') as f:
             json.dump(results, f, indent=2, default=str)
@@ -538,12 +1797,15 @@ def main():
     print("=" * 50)
     print("\nThis module provides:")
     print("  • Alpha diversity (Shannon, Simpson, Chao1)")
-    print("  • Beta diversity (Bray-Curtis, PCoA)")
+    print("  • Beta diversity (Bray-Curtis, PCoA, NMDS)")
+    print("  • Hierarchical clustering (average, complete, Ward)")
     print("  • Differential abundance (Wilcoxon, FDR correction)")
+    print("  • Drug class / mechanism / family rollups (sparse, cached)")
     print("\nUsage:")
     print("  from ecological_analysis import EcologicalAnalysis")
     print("  analyzer = EcologicalAnalysis()")
-    print("  results = analyzer.run_full_analysis(abundance_file, metadata_file)")
+    print("  results = analyzer.run_full_analysis(abundance_file, metadata_file,")
+    print("                                       summary_file=summary_file)")
     
     # Demo with synthetic data
     print("\n--- Demo with synthetic data ---")
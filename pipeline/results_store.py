@@ -0,0 +1,566 @@
+"""
+AMR Wastewater Thesis - Persistent Results Store
+=================================================
+
+Indexed SQLite database that accumulates pipeline results across runs.
+Each batch still writes pipeline_summary.json; the store additionally keeps
+per-sample ARG, drug class and mechanism counts, run metrics and manifest
+metadata, upserted by accession, so cross-run questions are one query.
+
+Author: AMR Thesis Project
+Last Updated: 2026-10-18
+
+Usage:
+    # Load a batch summary and its manifest
+    python results_store.py ingest --summary data/arg_annotation/pipeline_summary.json \\
+        --manifest data/metadata/sample_manifest.tsv
+
+    # Samples carrying NDM genes, 2020-2021, North India
+    python results_store.py query --feature 'NDM%' --like \\
+        --location '%North_India%' --date-from 2020 --date-to 2021
+
+    # Abundance matrix for EcologicalAnalysis.run_full_analysis
+    python results_store.py export --kind arg --output data/processed/arg_abundance.tsv
+"""
+
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+# ============================================================================
+# RESULTS STORE
+# ============================================================================
+
+class ResultsStore:
+    """Per-sample pipeline results and metadata in a single SQLite file."""
+
+    # Manifest columns stored as indexed columns; others go to extra_json
+    METADATA_COLUMNS = [
+        "bioproject", "sample_type", "location", "country", "collection_date",
+        "study_category", "zone", "platform", "read_type", "notes"
+    ]
+    INDEXED_METADATA = [
+        "bioproject", "sample_type", "location", "country", "collection_date",
+        "study_category", "zone"
+    ]
+
+    # Run metrics taken from a process_sample result dictionary. raw_reads
+    # and trimmed_reads come from fastp; prefilter_kept_reads is only set
+    # when the k-mer prefilter ran.
+    METRIC_COLUMNS = [
+        "qc_passed", "trimming_passed", "annotation_passed", "resfinder_passed",
+        "raw_reads", "trimmed_reads", "prefilter_kept_reads",
+        "gene_concordance", "drug_class_concordance"
+    ]
+
+    # Feature kind -> key of the parsed RGI results
+    FEATURE_KINDS = {
+        "arg": "arg_counts",
+        "drug_class": "drug_classes",
+        "mechanism": "mechanisms",
+        "family": "families"
+    }
+
+    # Page cache per connection; keeps index pages of bulk upserts in memory
+    CACHE_KB = 256 * 1024
+
+    SCHEMA = f"""
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            source      TEXT,
+            n_samples   INTEGER,
+            created_at  REAL
+        );
+        CREATE TABLE IF NOT EXISTS samples (
+            sample_key  INTEGER PRIMARY KEY,
+            accession   TEXT NOT NULL UNIQUE,
+            {", ".join(f"{c} TEXT" for c in METADATA_COLUMNS)},
+            extra_json  TEXT,
+            run_id      INTEGER REFERENCES runs (run_id),
+            {", ".join(f"{c} REAL" for c in METRIC_COLUMNS)},
+            updated_at  REAL
+        );
+        CREATE TABLE IF NOT EXISTS features (
+            feature_id  INTEGER PRIMARY KEY,
+            kind        TEXT NOT NULL,
+            name        TEXT NOT NULL,
+            UNIQUE (kind, name)
+        );
+        CREATE TABLE IF NOT EXISTS sample_features (
+            sample_key  INTEGER NOT NULL,
+            feature_id  INTEGER NOT NULL,
+            count       REAL NOT NULL,
+            PRIMARY KEY (sample_key, feature_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_sample_features_feature
+            ON sample_features (feature_id, sample_key);
+        {"".join(f"CREATE INDEX IF NOT EXISTS idx_samples_{c} ON samples ({c});"
+                 for c in INDEXED_METADATA)}
+        CREATE INDEX IF NOT EXISTS idx_samples_run ON samples (run_id);
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(self.SCHEMA)
+            self._add_missing_metric_columns(conn)
+        finally:
+            conn.close()
+
+    def _add_missing_metric_columns(self, conn: sqlite3.Connection):
+        """Add METRIC_COLUMNS introduced after a database was created."""
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(samples)")}
+        for column in self.METRIC_COLUMNS:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE samples ADD COLUMN {column} REAL")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection with manual transaction control."""
+        conn = sqlite3.connect(str(self.db_path), timeout=60.0,
+                               isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{self.CACHE_KB}")
+        return conn
+
+    # ------------------------------------------------------------------
+    # Ingestion
+    # ------------------------------------------------------------------
+
+    def ingest_manifest(self, manifest_file: Path) -> int:
+        """
+        Upsert sample metadata from a manifest TSV.
+
+        Metadata columns are replaced; run metrics and counts are kept.
+
+        Returns:
+            Number of manifest rows ingested
+        """
+        now = time.time()
+        rows = []
+
+        with open(manifest_file, 'r') as f:
+            header = f.readline().rstrip('\n').split('\t')
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                record = dict(zip(header, fields))
+                accession = record.pop("accession", "").strip()
+                if not accession:
+                    continue
+                metadata = [record.pop(c, "") or None for c in self.METADATA_COLUMNS]
+                extra = json.dumps(record) if any(record.values()) else None
+                rows.append((accession, *metadata, extra, now))
+
+        columns = ["accession", *self.METADATA_COLUMNS, "extra_json", "updated_at"]
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns[1:])
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                f"INSERT INTO samples ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT (accession) DO UPDATE SET {updates}",
+                rows
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        return len(rows)
+
+    @classmethod
+    def _metrics(cls, result: dict) -> List[Optional[float]]:
+        """Run metric values of one sample result, in METRIC_COLUMNS order."""
+        read_counts = result.get("read_counts") or {}
+        prefilter = result.get("prefilter") or {}
+        concordance = result.get("concordance") or {}
+        values = {
+            "qc_passed": result.get("qc_passed"),
+            "trimming_passed": result.get("trimming_passed"),
+            "annotation_passed": result.get("annotation_passed"),
+            "resfinder_passed": result.get("resfinder_passed"),
+            "raw_reads": read_counts.get("raw_reads"),
+            "trimmed_reads": read_counts.get("trimmed_reads"),
+            "prefilter_kept_reads": prefilter.get("kept_reads"),
+            "gene_concordance": (concordance.get("genes") or {}).get("jaccard"),
+            "drug_class_concordance": (concordance.get("drug_classes") or {}).get("jaccard"),
+        }
+        return [None if values[c] is None else float(values[c]) for c in cls.METRIC_COLUMNS]
+
+    def ingest_results(self, results: List[dict], source: Optional[str] = None) -> int:
+        """
+        Upsert per-sample results of one run in a single transaction.
+
+        A sample's run metrics and feature counts are replaced by the
+        latest run that contains it; its manifest metadata is kept.
+
+        Returns:
+            run_id of the recorded run
+        """
+        now = time.time()
+        # Last result wins when an accession appears more than once
+        results = list({r["sample_id"]: r for r in results if r.get("sample_id")}.values())
+        accessions = [r["sample_id"] for r in results]
+
+        # Feature vocabulary and counts, gathered before touching the database
+        counts: List[Tuple[str, str, str, float]] = []
+        for result in results:
+            arg_results = result.get("arg_results") or {}
+            for kind, key in self.FEATURE_KINDS.items():
+                for name, count in (arg_results.get(key) or {}).items():
+                    counts.append((result["sample_id"], kind, name, float(count)))
+        vocabulary = sorted({(kind, name) for _, kind, name, _ in counts})
+
+        metric_updates = ", ".join(f"{c} = excluded.{c}" for c in self.METRIC_COLUMNS)
+        columns = ["accession", "run_id", *self.METRIC_COLUMNS, "updated_at"]
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            run_id = conn.execute(
+                "INSERT INTO runs (source, n_samples, created_at) VALUES (?, ?, ?)",
+                (source, len(results), now)
+            ).lastrowid
+
+            conn.executemany(
+                f"INSERT INTO samples ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT (accession) DO UPDATE SET run_id = excluded.run_id, "
+                f"{metric_updates}, updated_at = excluded.updated_at",
+                [(r["sample_id"], run_id, *self._metrics(r), now) for r in results]
+            )
+
+            conn.executemany("INSERT OR IGNORE INTO features (kind, name) VALUES (?, ?)",
+                             vocabulary)
+            feature_ids = self._feature_ids(conn)
+            sample_keys = self._sample_keys(conn, accessions)
+
+            # Replace counts; rows sorted by primary key keep B-tree inserts sequential
+            conn.executemany("DELETE FROM sample_features WHERE sample_key = ?",
+                             [(sample_keys[a],) for a in accessions])
+            rows = sorted((sample_keys[a], feature_ids[(kind, name)], count)
+                          for a, kind, name, count in counts)
+
+            # Loads larger than the table are faster to index afterwards
+            existing = conn.execute("SELECT COUNT(*) FROM sample_features").fetchone()[0]
+            rebuild_index = len(rows) > existing
+            if rebuild_index:
+                conn.execute("DROP INDEX IF EXISTS idx_sample_features_feature")
+            conn.executemany(
+                "INSERT INTO sample_features (sample_key, feature_id, count) VALUES (?, ?, ?)",
+                rows
+            )
+            if rebuild_index:
+                conn.execute("CREATE INDEX idx_sample_features_feature "
+                             "ON sample_features (feature_id, sample_key)")
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        return run_id
+
+    def ingest_summary(self, summary_file: Path) -> int:
+        """Ingest the samples of a pipeline_summary.json; returns the run_id."""
+        with open(summary_file, 'r') as f:
+            summary = json.load(f)
+        return self.ingest_results(summary.get("samples", []), str(summary_file))
+
+    @staticmethod
+    def _feature_ids(conn: sqlite3.Connection) -> Dict[Tuple[str, str], int]:
+        return {(row["kind"], row["name"]): row["feature_id"]
+                for row in conn.execute("SELECT feature_id, kind, name FROM features")}
+
+    @staticmethod
+    def _sample_keys(conn: sqlite3.Connection, accessions: List[str]) -> Dict[str, int]:
+        wanted = set(accessions)
+        return {row["accession"]: row["sample_key"]
+                for row in conn.execute("SELECT sample_key, accession FROM samples")
+                if row["accession"] in wanted}
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def _metadata_filters(self,
+                          metadata: Dict[str, Any],
+                          date_from: Optional[str] = None,
+                          date_to: Optional[str] = None) -> Tuple[List[str], List[Any]]:
+        """
+        SQL conditions on samples (alias s) for metadata filters.
+
+        Values may be a string (exact, or SQL LIKE when it contains '%'),
+        or a list of alternatives. Dates compare on their leading characters,
+        so date_to='2021' includes '2021-06-30'.
+        """
+        clauses, params = [], []
+        for column, value in metadata.items():
+            if column not in self.METADATA_COLUMNS:
+                raise ValueError(f"Unknown metadata column: {column}")
+            if isinstance(value, (list, tuple, set)):
+                clauses.append(f"s.{column} IN ({', '.join('?' * len(value))})")
+                params.extend(value)
+            elif "%" in str(value):
+                clauses.append(f"s.{column} LIKE ?")
+                params.append(value)
+            else:
+                clauses.append(f"s.{column} = ?")
+                params.append(value)
+
+        if date_from is not None:
+            clauses.append("s.collection_date >= ?")
+            params.append(str(date_from))
+        if date_to is not None:
+            clauses.append("substr(s.collection_date, 1, ?) <= ?")
+            params.extend([len(str(date_to)), str(date_to)])
+
+        return clauses, params
+
+    def find_samples(self,
+                     feature: Optional[str] = None,
+                     kind: str = "arg",
+                     like: bool = False,
+                     date_from: Optional[str] = None,
+                     date_to: Optional[str] = None,
+                     **metadata) -> List[dict]:
+        """
+        Samples matching metadata filters and, optionally, carrying a feature.
+
+        Args:
+            feature: Feature name (ARO term, drug class or mechanism)
+            kind: 'arg', 'drug_class' or 'mechanism'
+            like: Treat feature as a SQL LIKE pattern (e.g. 'NDM%'). Plain
+                prefix patterns become a case-sensitive range on the
+                (kind, name) index; other patterns scan the kind's features
+            **metadata: Filters on METADATA_COLUMNS, e.g. location='%North_India%'
+
+        Returns:
+            One dictionary per sample (and matching feature) with metadata,
+            run metrics and, when feature is given, 'feature' and 'count'
+        """
+        clauses, params = self._metadata_filters(metadata, date_from, date_to)
+
+        if feature is None:
+            sql = "SELECT s.* FROM samples s"
+        else:
+            sql = ("SELECT s.*, f.name AS feature, sf.count FROM features f "
+                   "JOIN sample_features sf ON sf.feature_id = f.feature_id "
+                   "JOIN samples s ON s.sample_key = sf.sample_key")
+            bounds = self._prefix_bounds(feature) if like else None
+            if bounds:
+                clauses[:0] = ["f.kind = ?", "f.name >= ?", "f.name < ?"]
+                params[:0] = [kind, *bounds]
+            else:
+                clauses[:0] = ["f.kind = ?", f"f.name {'LIKE' if like else '='} ?"]
+                params[:0] = [kind, feature]
+
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY s.accession"
+
+        conn = self._connect()
+        # Plain tuples zipped with the column names; sqlite3.Row conversion
+        # dominates for broad patterns returning one row per sample and feature
+        conn.row_factory = None
+        try:
+            cursor = conn.execute(sql, params)
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _prefix_bounds(pattern: str) -> Optional[Tuple[str, str]]:
+        """[low, high) name range of a LIKE pattern that is a plain prefix."""
+        prefix = pattern[:-1]
+        if (not pattern.endswith("%") or not prefix or "%" in prefix or "_" in prefix
+                or ord(prefix[-1]) == sys.maxunicode):
+            return None
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def feature_prevalence(self, kind: str = "arg", **metadata) -> List[dict]:
+        """Number of samples carrying each feature among the filtered samples."""
+        clauses, params = self._metadata_filters(metadata)
+        where = " AND ".join(["f.kind = ?", *clauses])
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT f.name AS feature, COUNT(*) AS samples, SUM(sf.count) AS total_count "
+                "FROM features f "
+                "JOIN sample_features sf ON sf.feature_id = f.feature_id "
+                "JOIN samples s ON s.sample_key = sf.sample_key "
+                f"WHERE {where} GROUP BY f.feature_id ORDER BY samples DESC, feature",
+                [kind, *params]
+            )
+            return [dict(row) for row in rows]
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------
+    # Export
+    # ------------------------------------------------------------------
+
+    def abundance_matrix(self, kind: str = "arg",
+                         accessions: Optional[Iterable[str]] = None,
+                         include_unrun: bool = False,
+                         **metadata):
+        """
+        Features x Samples count table, the layout EcologicalAnalysis reads.
+
+        Samples with results but no counts of this kind are included as zero
+        columns. Manifest-only samples that were never run are left out
+        unless include_unrun is set, as they would read as empty samples.
+
+        Args:
+            accessions: Restrict to these samples (any number; passed
+                through a temporary table, not bound parameters)
+
+        Returns:
+            pandas DataFrame indexed by feature name, one column per accession
+        """
+        import numpy as np
+        import pandas as pd
+
+        clauses, params = self._metadata_filters(metadata)
+        if not include_unrun:
+            clauses.append("s.run_id IS NOT NULL")
+        if accessions is not None:
+            clauses.append("s.accession IN (SELECT accession FROM temp.selected_samples)")
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        conn = self._connect()
+        try:
+            if accessions is not None:
+                conn.execute("CREATE TEMP TABLE selected_samples "
+                             "(accession TEXT PRIMARY KEY) WITHOUT ROWID")
+                conn.executemany("INSERT OR IGNORE INTO temp.selected_samples VALUES (?)",
+                                 ((a,) for a in accessions))
+            samples = [row[0] for row in conn.execute(
+                f"SELECT s.accession FROM samples s {where} ORDER BY s.accession", params
+            )]
+            rows = conn.execute(
+                "SELECT s.accession, f.name, sf.count FROM samples s "
+                "JOIN sample_features sf ON sf.sample_key = s.sample_key "
+                "JOIN features f ON f.feature_id = sf.feature_id "
+                f"{where}{' AND' if where else 'WHERE'} f.kind = ?",
+                [*params, kind]
+            ).fetchall()
+        finally:
+            conn.close()
+
+        features = sorted({name for _, name, _ in rows})
+        sample_index = {a: i for i, a in enumerate(samples)}
+        feature_index = {name: i for i, name in enumerate(features)}
+
+        matrix = np.zeros((len(features), len(samples)))
+        if rows:
+            columns, names, values = zip(*rows)
+            matrix[[feature_index[n] for n in names],
+                   [sample_index[a] for a in columns]] = values
+
+        return pd.DataFrame(matrix, index=pd.Index(features, name="feature"),
+                            columns=samples)
+
+    def metadata_table(self, accessions: Optional[Iterable[str]] = None):
+        """Sample metadata indexed by accession (EcologicalAnalysis metadata file)."""
+        import pandas as pd
+
+        conn = self._connect()
+        try:
+            columns = ", ".join(["accession", *self.METADATA_COLUMNS])
+            table = pd.read_sql_query(f"SELECT {columns} FROM samples ORDER BY accession",
+                                      conn, index_col="accession")
+        finally:
+            conn.close()
+
+        return table if accessions is None else table.loc[list(accessions)]
+
+    def export_for_analysis(self, abundance_file: Path,
+                            metadata_file: Optional[Path] = None,
+                            kind: str = "arg", include_unrun: bool = False,
+                            **metadata):
+        """Write the TSV inputs of EcologicalAnalysis.run_full_analysis."""
+        abundance = self.abundance_matrix(kind, include_unrun=include_unrun, **metadata)
+        abundance_file.parent.mkdir(parents=True, exist_ok=True)
+        abundance.to_csv(abundance_file, sep='\t')
+
+        if metadata_file is not None:
+            metadata_file.parent.mkdir(parents=True, exist_ok=True)
+            self.metadata_table(abundance.columns).to_csv(metadata_file, sep='\t')
+
+
+# ============================================================================
+# ENTRY POINT
+# ============================================================================
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Command-line entry point for ingesting, querying and exporting."""
+    parser = argparse.ArgumentParser(description="AMR pipeline results store")
+    parser.add_argument("--db", type=Path, default=Path("data/arg_annotation/results.sqlite"),
+                        help="Results database file")
+
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest = commands.add_parser("ingest", help="Load a summary and/or a manifest")
+    ingest.add_argument("--summary", type=Path)
+    ingest.add_argument("--manifest", type=Path)
+
+    query = commands.add_parser("query", help="Find samples by feature and metadata")
+    query.add_argument("--feature")
+    query.add_argument("--kind", default="arg", choices=list(ResultsStore.FEATURE_KINDS))
+    query.add_argument("--like", action="store_true",
+                       help="Treat --feature as a SQL LIKE pattern")
+    query.add_argument("--date-from")
+    query.add_argument("--date-to")
+    for column in ResultsStore.INDEXED_METADATA:
+        if column != "collection_date":
+            query.add_argument(f"--{column.replace('_', '-')}", dest=column)
+
+    export = commands.add_parser("export", help="Write an abundance matrix TSV")
+    export.add_argument("--kind", default="arg", choices=list(ResultsStore.FEATURE_KINDS))
+    export.add_argument("--output", type=Path, required=True)
+    export.add_argument("--metadata-output", type=Path)
+    export.add_argument("--include-unrun", action="store_true",
+                        help="Also export manifest samples without results (as zeros)")
+
+    args = parser.parse_args(argv)
+    store = ResultsStore(args.db)
+
+    if args.command == "ingest":
+        if args.manifest:
+            print(f"Metadata rows: {store.ingest_manifest(args.manifest)}")
+        if args.summary:
+            print(f"Recorded run {store.ingest_summary(args.summary)}")
+
+    elif args.command == "query":
+        filters = {c: getattr(args, c) for c in ResultsStore.INDEXED_METADATA
+                   if c != "collection_date" and getattr(args, c)}
+        start = time.perf_counter()
+        rows = store.find_samples(args.feature, args.kind, args.like,
+                                  args.date_from, args.date_to, **filters)
+        elapsed = (time.perf_counter() - start) * 1000
+        for row in rows:
+            detail = f"\t{row['feature']}\t{row['count']:g}" if args.feature else ""
+            print(f"{row['accession']}\t{row['location']}\t{row['collection_date']}{detail}")
+        print(f"{len(rows)} rows in {elapsed:.1f} ms", file=sys.stderr)
+
+    elif args.command == "export":
+        store.export_for_analysis(args.output, args.metadata_output, args.kind,
+                                  include_unrun=args.include_unrun)
+        print(f"Abundance matrix written to: {args.output}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+AMR Wastewater Thesis - Spatial Gradient Analysis
+==================================================
+
+Ordered multi-group tests along the upstream → catchment → downstream
+gradient (MASTER_DOCUMENT Section 5). Samples are assigned to zones by the
+`zone` column of the sample manifest; every ARG and category total is tested
+in one pass of array operations over a features x samples matrix.
+
+Author: AMR Thesis Project
+Last Updated: 2026-10-18
+
+Analysis Components:
+1. Kruskal-Wallis H (any difference between zones, tie-corrected)
+2. Jonckheere-Terpstra (monotone trend along the zone order)
+3. Permutation p-values with shared label permutations for all features
+4. Benjamini-Hochberg FDR across all features tested together
+"""
+
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+ZONE_ORDER = ("upstream", "catchment", "downstream")
+
+
+# ============================================================================
+# RANK STRUCTURE
+# ============================================================================
+
+def _tie_blocks(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sort each row and locate runs of tied values.
+
+    Returns:
+        order: Column order that sorts each row
+        start: First sorted position of each position's tie block
+        end: One past the last sorted position of the block
+    """
+    order = np.argsort(values, axis=1, kind="stable")
+    ranked = np.take_along_axis(values, order, axis=1)
+    n_samples = ranked.shape[1]
+    positions = np.broadcast_to(np.arange(n_samples), ranked.shape)
+
+    new_block = np.ones(ranked.shape, dtype=bool)
+    new_block[:, 1:] = ranked[:, 1:] != ranked[:, :-1]
+    start = np.maximum.accumulate(np.where(new_block, positions, 0), axis=1)
+
+    block_end = np.ones(ranked.shape, dtype=bool)
+    block_end[:, :-1] = new_block[:, 1:]
+    end = np.minimum.accumulate(
+        np.where(block_end, positions + 1, n_samples)[:, ::-1], axis=1
+    )[:, ::-1]
+
+    return order, start, end
+
+
+def _benjamini_hochberg(p_values: np.ndarray) -> np.ndarray:
+    """Benjamini-Hochberg adjusted p-values, in input order."""
+    n = len(p_values)
+    if n == 0:
+        return p_values
+    order = np.argsort(p_values)
+    scaled = p_values[order] * n / np.arange(1, n + 1)
+    adjusted = np.minimum.accumulate(scaled[::-1])[::-1].clip(max=1.0)
+    result = np.empty(n)
+    result[order] = adjusted
+    return result
+
+
+# ============================================================================
+# GRADIENT ANALYSIS
+# ============================================================================
+
+class GradientAnalysis:
+    """
+    Kruskal-Wallis and Jonckheere-Terpstra tests across ordered zones.
+
+    Both statistics are computed from per-feature tie blocks that do not
+    change under relabelling, so each permutation of zone labels only costs
+    a few array operations over all features at once. Every feature sees
+    the same permutations, drawn from seed.
+    """
+
+    def __init__(self,
+                 zone_order: Sequence[str] = ZONE_ORDER,
+                 n_permutations: int = 999,
+                 seed: int = 0,
+                 max_batch_elements: int = 20_000_000):
+        self.zone_order = [zone.lower() for zone in zone_order]
+        self.n_permutations = n_permutations
+        self.seed = seed
+        self.max_batch_elements = max_batch_elements
+
+    def load_zones(self, manifest_file: Path,
+                   zone_column: str = "zone") -> pd.Series:
+        """
+        Read sample zones from the manifest.
+
+        Returns:
+            Series mapping accession to zone, for samples with a known zone
+        """
+        manifest = pd.read_csv(manifest_file, sep='\t', dtype=str)
+        if zone_column not in manifest.columns:
+            raise ValueError(f"Manifest has no '{zone_column}' column: {manifest_file}")
+
+        return self.select_zones(manifest.set_index("accession")[zone_column])
+
+    def select_zones(self, zone_values: pd.Series) -> pd.Series:
+        """Normalize zone labels and drop samples outside zone_order."""
+        zones = zone_values.dropna().astype(str).str.strip().str.lower()
+        return zones[zones.isin(self.zone_order)]
+
+    def _statistics(self, labels: np.ndarray, ranks: np.ndarray,
+                    start: np.ndarray, end: np.ndarray,
+                    order: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rank-sum score and JT statistic for a batch of labellings.
+
+        Args:
+            labels: Permutations x Samples zone codes
+            ranks, start, end, order: Tie structure from _tie_blocks
+
+        Returns:
+            (sum_g R_g^2 / n_g, JT), each Permutations x Features
+        """
+        n_zones = len(self.zone_order)
+        zones = np.arange(n_zones)
+
+        # Zone of each sorted position, per labelling and feature
+        sorted_labels = labels[:, order]                              # P x F x N
+        one_hot = (sorted_labels[..., None] == zones).astype(np.int32)  # P x F x N x G
+
+        group_sizes = np.bincount(labels[0], minlength=n_zones)
+        rank_sums = np.einsum("pfng,fn->pfg", one_hot, ranks)
+        score = (rank_sums ** 2 / np.maximum(group_sizes, 1)).sum(axis=2)
+
+        # JT: for each observation, count observations of lower zones that
+        # are smaller, ties counting one half. Per zone that is
+        # below + (through - below) / 2; the observation itself never falls
+        # in a lower zone, so it needs no correction.
+        cumulative = np.zeros(one_hot.shape[:2] + (one_hot.shape[2] + 1, n_zones),
+                              dtype=np.int32)
+        np.cumsum(one_hot, axis=2, out=cumulative[:, :, 1:])
+        below = np.take_along_axis(cumulative, start[None, :, :, None], axis=2)
+        through = np.take_along_axis(cumulative, end[None, :, :, None], axis=2)
+        lower_zone = zones < sorted_labels[..., None]
+        jt = 0.5 * ((below + through) * lower_zone).sum(axis=(2, 3))
+
+        return score, jt
+
+    def test_features(self,
+                      abundance_df: pd.DataFrame,
+                      zones: pd.Series,
+                      level: str = "arg") -> pd.DataFrame:
+        """
+        Test every feature for zone differences and monotone trends.
+
+        Args:
+            abundance_df: Features x Samples abundance matrix
+            zones: Series mapping sample IDs to zones in zone_order
+            level: Label stored in the 'level' column of the results
+
+        Returns:
+            DataFrame with per-zone means, statistics and permutation
+            p-values (unadjusted; see analyze() for FDR)
+        """
+        samples = [s for s in abundance_df.columns if s in zones.index]
+        codes = np.array([self.zone_order.index(zones[s]) for s in samples])
+        present = np.unique(codes)
+        if len(present) < 2:
+            raise ValueError("At least two zones with samples are required")
+
+        values = abundance_df[samples].to_numpy(dtype=float)
+
+        # Constant features carry no rank information
+        testable = (values != values[:, :1]).any(axis=1)
+        features = abundance_df.index[testable]
+        values = values[testable]
+
+        n = len(samples)
+        group_sizes = np.bincount(codes, minlength=len(self.zone_order))
+
+        order, start, end = _tie_blocks(values)
+        ranks = (start + end + 1) / 2.0  # mid-ranks at sorted positions
+
+        score, jt = self._statistics(codes[None, :], ranks, start, end, order)
+        score, jt = score[0], jt[0]
+        jt_expected = (n ** 2 - np.sum(group_sizes ** 2)) / 4.0
+
+        # Permutation null, in batches that bound memory
+        rng = np.random.default_rng(self.seed)
+        per_permutation = max(1, values.size * len(self.zone_order))
+        batch = max(1, self.max_batch_elements // per_permutation)
+        kw_exceed = np.zeros(len(features))
+        jt_exceed = np.zeros(len(features))
+        tolerance = 1e-9
+
+        for first in range(0, self.n_permutations, batch):
+            size = min(batch, self.n_permutations - first)
+            labels = rng.permuted(np.tile(codes, (size, 1)), axis=1)
+            perm_score, perm_jt = self._statistics(labels, ranks, start, end, order)
+            kw_exceed += (perm_score >= score - tolerance).sum(axis=0)
+            jt_exceed += (np.abs(perm_jt - jt_expected)
+                          >= np.abs(jt - jt_expected) - tolerance).sum(axis=0)
+
+        # Tie-corrected Kruskal-Wallis H
+        tie_sizes = (end - start).astype(float)
+        tie_correction = 1.0 - (tie_sizes ** 2 - 1).sum(axis=1) / (n ** 3 - n)
+        h = (12.0 / (n * (n + 1)) * score - 3 * (n + 1)) / tie_correction
+
+        result = pd.DataFrame({"feature": features, "level": level})
+        for code, zone in enumerate(self.zone_order):
+            if group_sizes[code]:
+                result[f"mean_{zone}"] = values[:, codes == code].mean(axis=1)
+
+        result["kw_statistic"] = np.round(h, 4)
+        result["kw_p_value"] = (kw_exceed + 1) / (self.n_permutations + 1)
+        result["jt_statistic"] = jt
+        result["jt_expected"] = jt_expected
+        result["trend"] = np.where(np.isclose(jt, jt_expected), "none",
+                                   np.where(jt > jt_expected, "increasing", "decreasing"))
+        result["jt_p_value"] = (jt_exceed + 1) / (self.n_permutations + 1)
+
+        return result
+
+    def analyze(self,
+                abundance_df: pd.DataFrame,
+                zones: pd.Series,
+                arg_to_class: Optional[Dict[str, str]] = None,
+                alpha: float = 0.05,
+                rollup=None) -> pd.DataFrame:
+        """
+        Test all ARGs (and their categories) with FDR across all features.
+
+        Args:
+            abundance_df: ARGs x Samples abundance matrix
+            zones: Series mapping sample IDs to zones
+            arg_to_class: Optional ARG -> drug class map; drug class totals
+                are tested alongside the ARGs
+            alpha: FDR threshold for the significance flags
+            rollup: Optional CategoryRollup; totals of each of its levels
+                are tested alongside the ARGs (replaces arg_to_class)
+        """
+        tables = [(abundance_df, "arg")]
+        if rollup is None and arg_to_class:
+            from ecological_analysis import CategoryRollup
+            rollup = CategoryRollup.from_arg_to_class(arg_to_class)
+        if rollup is not None:
+            tables.extend((table, level)
+                          for level, table in rollup.rollup_all(abundance_df).items())
+
+        result = pd.concat(
+            [self.test_features(table, zones, level) for table, level in tables],
+            ignore_index=True
+        )
+
+        for test in ["kw", "jt"]:
+            result[f"{test}_p_adjusted"] = _benjamini_hochberg(
+                result[f"{test}_p_value"].to_numpy()
+            )
+            result[f"{test}_significant"] = result[f"{test}_p_adjusted"] < alpha
+
+        return result.sort_values(["jt_p_adjusted", "kw_p_adjusted"]).reset_index(drop=True)
+
+    def run(self,
+            abundance_df: pd.DataFrame,
+            manifest_file: Path,
+            arg_to_class: Optional[Dict[str, str]] = None,
+            zone_column: str = "zone",
+            rollup=None) -> pd.DataFrame:
+        """Load zones from the manifest and analyze all features."""
+        zones = self.load_zones(manifest_file, zone_column)
+        return self.analyze(abundance_df, zones, arg_to_class, rollup=rollup)
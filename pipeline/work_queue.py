@@ -0,0 +1,510 @@
+"""
+AMR Wastewater Thesis - Distributed Batch Execution
+====================================================
+
+Work-queue mode for spreading a manifest across several worker processes,
+on one host or on many hosts sharing a filesystem. A coordinator publishes
+manifest samples into a SQLite-backed queue; workers claim samples with
+time-limited leases, heartbeat while the tools run and retry failures.
+The coordinator merges finished results into one pipeline_summary.json.
+
+Author: AMR Thesis Project
+Last Updated: 2026-10-18
+
+Usage:
+    # Coordinator with 4 local workers
+    python work_queue.py coordinator data/metadata/sample_manifest.tsv --workers 4
+
+    # Additional worker on another node sharing the queue file
+    python work_queue.py worker --queue data/arg_annotation/work_queue.sqlite
+
+Note: SQLite locking relies on POSIX advisory locks. Shared filesystems
+must support them (e.g. NFSv4, Lustre, GPFS); NFSv3 without lockd does not.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from amr_pipeline import AMRPipeline, PipelineConfig
+
+
+# ============================================================================
+# SQLITE WORK QUEUE
+# ============================================================================
+
+class SQLiteWorkQueue:
+    """Lease-based sample queue stored in a single SQLite file."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            accession     TEXT PRIMARY KEY,
+            r1_path       TEXT NOT NULL,
+            r2_path       TEXT,
+            status        TEXT NOT NULL DEFAULT 'pending',
+            attempts      INTEGER NOT NULL DEFAULT 0,
+            worker_id     TEXT,
+            lease_expires REAL,
+            heartbeat_at  REAL,
+            result_json   TEXT,
+            error         TEXT,
+            updated_at    REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_tasks_status
+            ON tasks (status, lease_expires);
+    """
+
+    def __init__(self,
+                 db_path: Path,
+                 lease_seconds: float = 600.0,
+                 max_attempts: int = 3):
+        """
+        Args:
+            db_path: Queue file (on a filesystem visible to all workers)
+            lease_seconds: How long a claim stays valid without a heartbeat
+            max_attempts: Claims allowed per sample before it is marked failed
+        """
+        self.db_path = Path(db_path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(self.SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection with manual transaction control."""
+        conn = sqlite3.connect(str(self.db_path), timeout=60.0,
+                               isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def publish(self, samples: List[Tuple[str, Path, Optional[Path]]]) -> int:
+        """
+        Add samples to the queue. Already-published accessions are kept as is.
+
+        Returns:
+            Number of newly queued samples
+        """
+        now = time.time()
+        rows = [
+            (accession, str(r1), str(r2) if r2 else None, now)
+            for accession, r1, r2 in samples
+        ]
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            before = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (accession, r1_path, r2_path, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                rows
+            )
+            after = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        return after - before
+
+    def claim(self, worker_id: str) -> Optional[Tuple[str, Path, Optional[Path]]]:
+        """
+        Claim the next pending sample, or one whose lease has expired.
+
+        Returns:
+            (accession, r1_path, r2_path) or None if nothing is claimable
+        """
+        now = time.time()
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT accession, r1_path, r2_path FROM tasks "
+                "WHERE attempts < ? AND (status = 'pending' "
+                "OR (status = 'running' AND lease_expires < ?)) "
+                "ORDER BY attempts, accession LIMIT 1",
+                (self.max_attempts, now)
+            ).fetchone()
+
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            conn.execute(
+                "UPDATE tasks SET status = 'running', attempts = attempts + 1, "
+                "worker_id = ?, lease_expires = ?, heartbeat_at = ?, updated_at = ? "
+                "WHERE accession = ?",
+                (worker_id, now + self.lease_seconds, now, now, row["accession"])
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        r2 = Path(row["r2_path"]) if row["r2_path"] else None
+        return row["accession"], Path(row["r1_path"]), r2
+
+    def heartbeat(self, accession: str, worker_id: str) -> bool:
+        """
+        Extend the lease on a claimed sample.
+
+        Returns:
+            False if the lease was lost to another worker
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE tasks SET lease_expires = ?, heartbeat_at = ? "
+                "WHERE accession = ? AND worker_id = ? AND status = 'running'",
+                (now + self.lease_seconds, now, accession, worker_id)
+            )
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def complete(self, accession: str, worker_id: str, result: dict) -> bool:
+        """Store the result of a finished sample."""
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE tasks SET status = 'done', result_json = ?, error = NULL, "
+                "lease_expires = NULL, updated_at = ? "
+                "WHERE accession = ? AND worker_id = ? AND status = 'running'",
+                (json.dumps(result, default=str), time.time(), accession, worker_id)
+            )
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def fail(self, accession: str, worker_id: str, error: str,
+             result: Optional[dict] = None) -> bool:
+        """
+        Release a failed sample for retry, or mark it failed for good.
+
+        result, if given, is kept as the record of the last attempt.
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE tasks SET "
+                "status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                "result_json = ?, error = ?, lease_expires = NULL, updated_at = ? "
+                "WHERE accession = ? AND worker_id = ? AND status = 'running'",
+                (self.max_attempts,
+                 json.dumps(result, default=str) if result is not None else None,
+                 error, time.time(), accession, worker_id)
+            )
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def counts(self) -> Dict[str, int]:
+        """Number of samples per status."""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) FROM tasks GROUP BY status"
+            ).fetchall()
+        finally:
+            conn.close()
+        return {status: count for status, count in rows}
+
+    def is_drained(self) -> bool:
+        """True when no sample is pending, running or retryable."""
+        conn = self._connect()
+        try:
+            # A running sample is outstanding while its lease holds, or
+            # after expiry if it still has attempts left.
+            outstanding = conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status = 'pending' "
+                "OR (status = 'running' AND (lease_expires >= ? OR attempts < ?))",
+                (time.time(), self.max_attempts)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        return outstanding == 0
+
+    def expire_exhausted(self) -> int:
+        """Mark samples whose final lease ran out as failed."""
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE tasks SET status = 'failed', "
+                "error = COALESCE(error, 'lease expired'), updated_at = ? "
+                "WHERE status = 'running' AND attempts >= ? AND lease_expires < ?",
+                (time.time(), self.max_attempts, time.time())
+            )
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def results(self) -> List[dict]:
+        """Collect per-sample results in accession order."""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT accession, status, attempts, result_json, error "
+                "FROM tasks ORDER BY accession"
+            ).fetchall()
+        finally:
+            conn.close()
+
+        all_results = []
+        for row in rows:
+            if row["result_json"]:
+                all_results.append(json.loads(row["result_json"]))
+            else:
+                all_results.append({
+                    "sample_id": row["accession"],
+                    "qc_passed": False,
+                    "trimming_passed": False,
+                    "annotation_passed": False,
+                    "arg_results": None,
+                    "error": row["error"] or row["status"]
+                })
+        return all_results
+
+
+# ============================================================================
+# WORKER
+# ============================================================================
+
+class QueueWorker:
+    """Claims samples from the queue and runs them through AMRPipeline."""
+
+    def __init__(self,
+                 queue: SQLiteWorkQueue,
+                 config: PipelineConfig,
+                 worker_id: Optional[str] = None,
+                 poll_interval: float = 5.0):
+        self.queue = queue
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.pipeline = AMRPipeline(config)
+        self.logger = self.pipeline.logger
+
+    def _heartbeat_loop(self, accession: str, stop: threading.Event):
+        """Renew the lease until the sample finishes."""
+        interval = max(self.queue.lease_seconds / 3.0, 0.1)
+        while not stop.wait(interval):
+            if not self.queue.heartbeat(accession, self.worker_id):
+                self.logger.warning(f"Lease lost for {accession}")
+                return
+
+    @staticmethod
+    def failure_reason(result: dict) -> Optional[str]:
+        """Error of a process_sample result that should be retried, if any."""
+        if result.get("error"):
+            return str(result["error"])
+        if not result.get("trimming_passed"):
+            return "trimming failed"
+        if not result.get("annotation_passed"):
+            return "annotation failed"
+        return None
+
+    def run_one(self) -> bool:
+        """
+        Claim and process a single sample.
+
+        Returns:
+            False if there was nothing to claim
+        """
+        claimed = self.queue.claim(self.worker_id)
+        if claimed is None:
+            return False
+
+        accession, r1, r2 = claimed
+        self.logger.info(f"[{self.worker_id}] Claimed {accession}")
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat_loop, args=(accession, stop), daemon=True
+        )
+        heartbeat.start()
+
+        try:
+            result = self.pipeline.process_sample(accession, r1, r2)
+        except Exception as e:
+            stop.set()
+            heartbeat.join()
+            self.logger.error(f"[{self.worker_id}] {accession} failed: {e}")
+            self.queue.fail(accession, self.worker_id, str(e))
+            return True
+
+        stop.set()
+        heartbeat.join()
+        result["worker_id"] = self.worker_id
+
+        # Tool failures come back as a result, not an exception
+        error = self.failure_reason(result)
+        if error:
+            self.logger.error(f"[{self.worker_id}] {accession} failed: {error}")
+            self.queue.fail(accession, self.worker_id, error, result)
+            return True
+
+        if not self.queue.complete(accession, self.worker_id, result):
+            self.logger.warning(
+                f"[{self.worker_id}] Result for {accession} discarded (lease lost)"
+            )
+        return True
+
+    def run(self, exit_when_drained: bool = True) -> int:
+        """
+        Process samples until the queue is drained.
+
+        Returns:
+            Number of samples this worker attempted
+        """
+        processed = 0
+        while True:
+            if self.run_one():
+                processed += 1
+                continue
+            if exit_when_drained and self.queue.is_drained():
+                break
+            time.sleep(self.poll_interval)
+
+        self.logger.info(f"[{self.worker_id}] Queue drained after {processed} samples")
+        return processed
+
+
+def _worker_process(db_path: str, lease_seconds: float, max_attempts: int,
+                    config: PipelineConfig, poll_interval: float):
+    """Entry point for locally spawned worker processes."""
+    queue = SQLiteWorkQueue(Path(db_path), lease_seconds, max_attempts)
+    QueueWorker(queue, config, poll_interval=poll_interval).run()
+
+
+# ============================================================================
+# COORDINATOR
+# ============================================================================
+
+class QueueCoordinator:
+    """Publishes manifest samples and merges results from all workers."""
+
+    def __init__(self,
+                 config: PipelineConfig,
+                 queue_path: Optional[Path] = None,
+                 lease_seconds: float = 600.0,
+                 max_attempts: int = 3):
+        self.config = config
+        self.pipeline = AMRPipeline(config)
+        self.logger = self.pipeline.logger
+
+        queue_path = queue_path or config.arg_results_dir / "work_queue.sqlite"
+        self.queue = SQLiteWorkQueue(queue_path, lease_seconds, max_attempts)
+
+    def publish_manifest(self, manifest_file: Path) -> int:
+        """Queue every manifest sample whose reads are present."""
+        samples = self.pipeline.load_manifest(manifest_file)
+        added = self.queue.publish(samples)
+        self.logger.info(f"Published {added} new samples to {self.queue.db_path}")
+        return added
+
+    def start_local_workers(self, n_workers: int,
+                            poll_interval: float = 5.0) -> List[multiprocessing.Process]:
+        """
+        Spawn worker processes on this host.
+
+        Workers start with 'spawn' so they do not inherit the coordinator's
+        log handlers (every line would be logged twice).
+        """
+        context = multiprocessing.get_context("spawn")
+        workers = []
+        for _ in range(n_workers):
+            process = context.Process(
+                target=_worker_process,
+                args=(str(self.queue.db_path), self.queue.lease_seconds,
+                      self.queue.max_attempts, self.config, poll_interval)
+            )
+            process.start()
+            workers.append(process)
+        return workers
+
+    def wait(self, poll_interval: float = 10.0):
+        """Block until every sample is done or has exhausted its retries."""
+        while True:
+            self.queue.expire_exhausted()
+            if self.queue.is_drained():
+                return
+            self.logger.info(f"Queue status: {self.queue.counts()}")
+            time.sleep(poll_interval)
+
+    def merge_results(self, manifest_file: Optional[Path] = None) -> List[dict]:
+        """Write results from all workers into pipeline_summary.json."""
+        all_results = self.queue.results()
+        self.pipeline.run_batch_multiqc()
+        self.pipeline.generate_summary(all_results, manifest_file)
+        return all_results
+
+    def run(self, manifest_file: Path, n_workers: int = 0,
+            poll_interval: float = 10.0) -> List[dict]:
+        """
+        Publish a manifest, optionally start local workers, wait and merge.
+
+        Args:
+            manifest_file: Sample manifest TSV
+            n_workers: Local worker processes to start (0 = external workers only)
+            poll_interval: Seconds between queue status checks
+        """
+        self.publish_manifest(manifest_file)
+        workers = self.start_local_workers(n_workers, poll_interval)
+
+        self.wait(poll_interval)
+        for process in workers:
+            process.join()
+
+        return self.merge_results(manifest_file)
+
+
+# ============================================================================
+# ENTRY POINT
+# ============================================================================
+
+def main(argv: Optional[List[str]] = None):
+    """Command-line entry point for coordinator and worker roles."""
+    parser = argparse.ArgumentParser(description="AMR pipeline work queue")
+    parser.add_argument("--queue", type=Path, default=None,
+                        help="Queue file (default: <arg_results_dir>/work_queue.sqlite)")
+    parser.add_argument("--lease", type=float, default=600.0,
+                        help="Lease duration in seconds")
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--poll", type=float, default=10.0,
+                        help="Seconds between queue polls")
+
+    roles = parser.add_subparsers(dest="role", required=True)
+    coordinator = roles.add_parser("coordinator", help="Publish samples and merge results")
+    coordinator.add_argument("manifest", type=Path)
+    coordinator.add_argument("--workers", type=int, default=0,
+                             help="Local worker processes to start")
+    roles.add_parser("worker", help="Claim and process samples")
+
+    args = parser.parse_args(argv)
+    config = PipelineConfig()
+
+    if args.role == "coordinator":
+        coord = QueueCoordinator(config, args.queue, args.lease, args.max_attempts)
+        results = coord.run(args.manifest, args.workers, args.poll)
+        print(f"Merged {len(results)} samples into pipeline_summary.json")
+        return results
+
+    queue_path = args.queue or config.arg_results_dir / "work_queue.sqlite"
+    queue = SQLiteWorkQueue(queue_path, args.lease, args.max_attempts)
+    return QueueWorker(queue, config, poll_interval=args.poll).run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])